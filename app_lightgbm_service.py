@@ -1,33 +1,90 @@
-import glob
-import io
+import json
 import logging
 import os
-import zipfile
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 from pathlib import Path
+from typing import Callable, Dict, Optional
 
-import lightgbm as lgb
+import numpy as np
 import pandas as pd
-from flask import Flask, jsonify, request, send_file
+from flask import Flask, Response, jsonify, request, send_file, stream_with_context
 from werkzeug.utils import secure_filename
 
+from archive_stream import ArchiveCache, iter_zip, list_entries
+from lightgbm_engine import (
+    BASE_DIR,
+    DEFAULT_CACHE_DIR,
+    OUTPUT_FORMATS,
+    EngineSettings,
+    MicroBatcher,
+    ModelRegistry,
+    ModelSelection,
+    ScoringEngine,
+    check_output_options,
+    default_model_dir,
+    get_engine,
+    rank_features,
+)
+from prediction_store import DEFAULT_STORE_PATH, PredictionStore
+
 
 logging.basicConfig(
     level=logging.INFO,
     format="%(asctime)s [%(levelname)s] %(message)s",
 )
 
-BASE_DIR = Path(__file__).resolve().parent
 UPLOAD_FOLDER = BASE_DIR / "uploads"
-SERVER_MODEL_DIR = Path("17_models")
-LOCAL_MODEL_DIR = BASE_DIR / "models"
 
 app = Flask(__name__)
 app.config["UPLOAD_FOLDER"] = str(UPLOAD_FOLDER)
-app.config["MODEL_DIR"] = (
-    str(SERVER_MODEL_DIR) if SERVER_MODEL_DIR.exists() else str(LOCAL_MODEL_DIR)
-)
+app.config["MODEL_DIR"] = default_model_dir()
 app.config["MAX_CONTENT_LENGTH"] = 16 * 1024 * 1024  # 16 MB limit
-app.config["ALLOWED_EXTENSIONS"] = {"xlsx", "xls", "csv"}
+app.config["ALLOWED_EXTENSIONS"] = {"xlsx", "xls", "csv", "parquet", "feather", "arrow"}
+# Per-deployment preprocessing schema (JSON); defaults to MODEL_DIR/preprocessing.json.
+app.config["PREPROCESSING_SCHEMA"] = os.getenv("MEDLI_PREPROCESSING_SCHEMA")
+# Content-addressed prediction cache; set MEDLI_PREDICTION_CACHE_MAX_BYTES=0 to disable.
+app.config["PREDICTION_CACHE_DIR"] = os.getenv(
+    "MEDLI_PREDICTION_CACHE_DIR", str(DEFAULT_CACHE_DIR)
+)
+app.config["PREDICTION_CACHE_MAX_BYTES"] = int(
+    os.getenv("MEDLI_PREDICTION_CACHE_MAX_BYTES", str(1 << 30))
+)
+# Format of the predictions_* file: csv, parquet or feather (Arrow IPC).
+app.config["OUTPUT_FORMAT"] = os.getenv("MEDLI_OUTPUT_FORMAT", "csv")
+# Compression of prediction files ("", gzip or zstd) and CSV significant digits (0 = full).
+app.config["OUTPUT_COMPRESSION"] = os.getenv("MEDLI_OUTPUT_COMPRESSION", "")
+app.config["OUTPUT_PRECISION"] = int(os.getenv("MEDLI_OUTPUT_PRECISION", "0"))
+# Cores shared by all in-flight predictions (split across requests, then models).
+app.config["INFERENCE_CPU_BUDGET"] = int(
+    os.getenv("MEDLI_CPU_BUDGET", str(os.cpu_count() or 1))
+)
+# Rows per chunk for streaming CSV scoring; 0 scores the whole upload at once.
+app.config["STREAM_CHUNK_ROWS"] = int(os.getenv("MEDLI_STREAM_CHUNK_ROWS", "0"))
+# Background prediction jobs (/api/login with async=1).
+app.config["ASYNC_UPLOADS"] = os.getenv("MEDLI_ASYNC_UPLOADS", "0") == "1"
+app.config["JOB_WORKERS"] = int(os.getenv("MEDLI_JOB_WORKERS", "2"))
+app.config["JOB_MAX_PENDING"] = int(os.getenv("MEDLI_JOB_MAX_PENDING", "32"))
+app.config["JOB_TTL_SECONDS"] = int(os.getenv("MEDLI_JOB_TTL_SECONDS", "3600"))
+# Job state shared by pre-fork workers, so any worker answers /api/jobs polls;
+# "" keeps jobs in the process that accepted them (single-process servers only).
+app.config["JOB_STATE_DIR"] = os.getenv("MEDLI_JOB_STATE_DIR", str(BASE_DIR / "data" / "jobs"))
+# /api/score micro-batching: requests arriving within the window share one predict call.
+app.config["SCORE_BATCH_WINDOW_MS"] = float(os.getenv("MEDLI_SCORE_BATCH_WINDOW_MS", "5"))
+app.config["SCORE_BATCH_MAX_ROWS"] = int(os.getenv("MEDLI_SCORE_BATCH_MAX_ROWS", "1024"))
+app.config["SCORE_TIMEOUT_SECONDS"] = float(os.getenv("MEDLI_SCORE_TIMEOUT_SECONDS", "30"))
+# Finished /api/download-all archives, keyed on the directory listing; "" disables the cache.
+app.config["ARCHIVE_CACHE_DIR"] = os.getenv(
+    "MEDLI_ARCHIVE_CACHE_DIR", str(BASE_DIR / ".cache" / "archives")
+)
+# Largest per-row top-k accepted for feature contributions (pred_contrib).
+app.config["CONTRIBUTIONS_MAX_K"] = int(os.getenv("MEDLI_CONTRIBUTIONS_MAX_K", "50"))
+# SQLite store of every prediction, queried per participant; "" disables it.
+app.config["PREDICTION_STORE"] = os.getenv("MEDLI_PREDICTION_STORE", str(DEFAULT_STORE_PATH))
 
 UPLOAD_FOLDER.mkdir(parents=True, exist_ok=True)
 logging.info("Upload folder ready at %s", app.config["UPLOAD_FOLDER"])
@@ -41,80 +98,456 @@ def allowed_file(filename: str) -> bool:
     )
 
 
-def _prepare_results_frame(new_data: pd.DataFrame) -> pd.DataFrame:
-    """Ensure we always have an ID column to anchor predictions."""
-    if "eid" in new_data.columns:
-        return pd.DataFrame({"eid": new_data["eid"].copy()})
+def _engine_settings() -> EngineSettings:
+    return EngineSettings(
+        model_dir=str(app.config["MODEL_DIR"]),
+        cpu_budget=app.config["INFERENCE_CPU_BUDGET"],
+        schema_path=app.config["PREPROCESSING_SCHEMA"],
+        cache_dir=app.config["PREDICTION_CACHE_DIR"],
+        cache_max_bytes=app.config["PREDICTION_CACHE_MAX_BYTES"],
+    )
 
-    temp_ids = pd.Series(range(1, len(new_data) + 1), name="row_id")
-    new_data["row_id"] = temp_ids
-    return pd.DataFrame({"row_id": temp_ids})
 
+def get_scoring_engine() -> ScoringEngine:
+    """Return the scoring engine for the current app.config (see lightgbm_engine.py)."""
+    return get_engine(_engine_settings())
 
-def predict_with_models(filepath: str, user_dir: str):
-    """
-    Run every LightGBM model on the uploaded file and return (prediction_file, summary).
-    """
-    logging.info("Reading uploaded file: %s", filepath)
-    if filepath.lower().endswith(".csv"):
-        new_data = pd.read_csv(filepath)
-    else:
-        new_data = pd.read_excel(filepath)
-    logging.info("File loaded successfully. Shape: %s", new_data.shape)
 
-    model_files = glob.glob(os.path.join(app.config["MODEL_DIR"], "*.model"))
-    logging.info("Discovered %d model files", len(model_files))
-    if not model_files:
-        raise FileNotFoundError("No LightGBM models were found in MODEL_DIR.")
+def get_model_registry() -> ModelRegistry:
+    """Return the process-wide registry for app.config["MODEL_DIR"], refreshed."""
+    return get_scoring_engine().refresh()
+
+
+def predict_with_models(filepath: str, user_dir: str, **options):
+    """Score an uploaded file with the configured engine; see ``ScoringEngine.predict_file``."""
+    options.setdefault("compression", app.config["OUTPUT_COMPRESSION"] or None)
+    options.setdefault("precision", app.config["OUTPUT_PRECISION"] or None)
+    return get_scoring_engine().predict_file(filepath, user_dir, **options)
+
 
-    results = _prepare_results_frame(new_data)
+_service_lock = threading.Lock()
+_batcher: Optional[MicroBatcher] = None
+_store: Optional[PredictionStore] = None
 
-    if "sex" in new_data.columns:
-        new_data["sex"] = new_data["sex"].apply(
-            lambda x: 1 if x in ("male", 1, "1") else 0
+
+def get_batcher() -> MicroBatcher:
+    """Return the process-wide micro-batcher behind /api/score."""
+    global _batcher
+    engine = get_scoring_engine()
+    with _service_lock:
+        if _batcher is None or _batcher.engine is not engine:
+            _batcher = MicroBatcher(
+                engine,
+                app.config["SCORE_BATCH_WINDOW_MS"] / 1000.0,
+                app.config["SCORE_BATCH_MAX_ROWS"],
+            )
+        return _batcher
+
+
+def get_prediction_store() -> Optional[PredictionStore]:
+    """Return the prediction store for app.config["PREDICTION_STORE"], or None if disabled."""
+    global _store
+    path = app.config["PREDICTION_STORE"]
+    if not path:
+        return None
+    with _service_lock:
+        if _store is None or _store.path != str(path):
+            _store = PredictionStore(path)
+        return _store
+
+
+def _store_predictions(
+    username: str, filepath: str, result_filepath: str, output_format: str, run_info: dict
+):
+    """Record a finished prediction file in the store; a failure here never fails the upload."""
+    store = get_prediction_store()
+    if store is None:
+        return
+    try:
+        run_info["store_run_id"] = store.ingest(
+            result_filepath,
+            username,
+            os.path.basename(filepath),
+            run_info.get("model_version", ""),
+            run_info.get("models_run", []),
+            output_format=output_format,
         )
+    except Exception:  # noqa: BLE001
+        logging.exception("Could not store predictions from %s", result_filepath)
+        return
+    if run_info["store_run_id"] is None:
+        logging.warning("Predictions from %s were not recorded in the store", filepath)
+
+
+JOB_ID_PATTERN = re.compile(r"[0-9a-f]{32}")
+
+
+class JobQueueFull(RuntimeError):
+    """Raised when the background job queue already holds its maximum of pending jobs."""
+
+
+@dataclass
+class PredictionJob:
+    """State of one background prediction run, as reported by /api/jobs/<job_id>."""
+
+    job_id: str
+    filename: str
+    filepath: str
+    user_dir: str
+    output_format: str = "csv"
+    selection: ModelSelection = field(default_factory=ModelSelection)
+    contributions: int = 0
+    status: str = "queued"
+    created_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    models: Dict[str, str] = field(default_factory=dict)
+    result: Optional[dict] = None
+    error: Optional[str] = None
+
+    @property
+    def finished(self) -> bool:
+        return self.status in {"succeeded", "failed"}
+
+    def describe(self) -> dict:
+        # Pool threads add entries through ``progress``; work from one snapshot.
+        models = dict(self.models)
+        return {
+            "job_id": self.job_id,
+            "filename": self.filename,
+            "status": self.status,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "models": models,
+            "models_done": sum(status != "running" for status in models.values()),
+            "error": self.error,
+        }
+
+
+class JobQueue:
+    """
+    Bounded local worker pool for prediction jobs; no external broker.
 
-    for model_file in model_files:
-        model_name = Path(model_file).stem
-        logging.info("Running model: %s", model_name)
-        try:
-            booster = lgb.Booster(model_file=model_file)
-            feature_order = booster.feature_name()
-
-            missing = set(feature_order) - set(new_data.columns)
-            if missing:
-                logging.warning(
-                    "Model %s is missing %d features. Filling with zeros.",
-                    model_name,
-                    len(missing),
-                )
-                for feature in missing:
-                    new_data[feature] = 0
+    Jobs run on a thread pool (model inference releases the GIL). At most
+    ``max_pending`` unfinished jobs are accepted, and finished jobs are kept
+    for ``ttl_seconds`` so clients can fetch their results.
+
+    With a ``state_dir`` every job's state is also written to
+    ``<state_dir>/<job_id>.json``, so any pre-fork worker can answer a poll
+    for a job another worker runs. A job left unfinished by a worker that
+    exited is reported as failed.
+    """
 
-            X_predict = new_data[feature_order]
-            predictions = booster.predict(X_predict)
-            results[model_name] = predictions
+    # Minimum seconds between state writes for per-model progress updates.
+    SAVE_INTERVAL = 0.5
+
+    def __init__(
+        self,
+        max_workers: int,
+        max_pending: int,
+        ttl_seconds: int,
+        state_dir: Optional[str] = None,
+    ):
+        self.max_workers = max(1, int(max_workers))
+        self.max_pending = max(1, int(max_pending))
+        self.ttl_seconds = ttl_seconds
+        self.state_dir = state_dir or None
+        self._jobs: Dict[str, PredictionJob] = {}
+        self._saved_at: Dict[str, float] = {}
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+        if self.state_dir:
+            os.makedirs(self.state_dir, exist_ok=True)
+
+    def submit(self, job: PredictionJob, run: Callable[[PredictionJob], dict]) -> PredictionJob:
+        with self._lock:
+            self._prune()
+            pending = sum(not existing.finished for existing in self._jobs.values())
+            if pending >= self.max_pending:
+                raise JobQueueFull(f"{pending} prediction jobs are already pending.")
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers, thread_name_prefix="prediction-job"
+                )
+            self._jobs[job.job_id] = job
+            self.save(job, force=True)
+            self._executor.submit(self._run, job, run)
+        return job
+
+    def get(self, job_id: str) -> Optional[PredictionJob]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None and self.state_dir:
+            job = self._load(job_id)
+        return job
+
+    def save(self, job: PredictionJob, force: bool = False) -> None:
+        """Write the job's state for other workers; progress updates are rate-limited."""
+        if not self.state_dir:
+            return
+        now = time.monotonic()
+        if not force and now - self._saved_at.get(job.job_id, 0.0) < self.SAVE_INTERVAL:
+            return
+        self._saved_at[job.job_id] = now
+        state = job.describe()
+        state.update(filepath=job.filepath, user_dir=job.user_dir, result=job.result)
+        state["pid"] = os.getpid()
+        path = self._state_path(job.job_id)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as handle:
+                json.dump(state, handle)
+            os.replace(tmp_path, path)
+        except OSError:
+            logging.exception("Could not save the state of job %s", job.job_id)
+
+    def drain(self, timeout: float, heartbeat: Optional[Callable[[], None]] = None) -> None:
+        """
+        Wait up to ``timeout`` seconds for this process's unfinished jobs.
+
+        Called when a worker exits; ``heartbeat`` keeps the master from
+        killing the worker while it waits. Jobs still unfinished afterwards
+        are marked failed.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._lock:
+                unfinished = [job for job in self._jobs.values() if not job.finished]
+            if not unfinished or time.monotonic() >= deadline:
+                break
+            if heartbeat is not None:
+                heartbeat()
+            time.sleep(1.0)
+        for job in unfinished:
+            job.error = "Prediction interrupted: the worker running it shut down."
+            job.status = "failed"
+            job.finished_at = time.time()
+            self.save(job, force=True)
+
+    def _state_path(self, job_id: str) -> str:
+        return os.path.join(self.state_dir, f"{job_id}.json")
+
+    def _load(self, job_id: str) -> Optional[PredictionJob]:
+        if not JOB_ID_PATTERN.fullmatch(job_id):
+            return None
+        try:
+            with open(self._state_path(job_id), encoding="utf-8") as handle:
+                state = json.load(handle)
+        except (OSError, ValueError):
+            return None
+        job = PredictionJob(
+            job_id=state["job_id"],
+            filename=state["filename"],
+            filepath=state["filepath"],
+            user_dir=state["user_dir"],
+            status=state["status"],
+            created_at=state["created_at"],
+            started_at=state["started_at"],
+            finished_at=state["finished_at"],
+            models=state["models"],
+            result=state["result"],
+            error=state["error"],
+        )
+        if not job.finished and not _process_alive(state["pid"]):
+            job.error = "Prediction interrupted: the worker running it exited."
+            job.status = "failed"
+        return job
+
+    def _run(self, job: PredictionJob, run: Callable[[PredictionJob], dict]) -> None:
+        job.status = "running"
+        job.started_at = time.time()
+        self.save(job, force=True)
+        try:
+            job.result = run(job)
+            job.status = "succeeded"
         except Exception as err:  # noqa: BLE001
-            logging.exception("Model %s failed: %s", model_name, err)
-            results[model_name] = None
+            logging.exception("Prediction job %s failed", job.job_id)
+            job.error = f"Prediction failed: {err}"
+            job.status = "failed"
+        finally:
+            job.finished_at = time.time()
+            self.save(job, force=True)
+
+    def _prune(self) -> None:
+        cutoff = time.time() - self.ttl_seconds
+        expired = [
+            job_id
+            for job_id, job in self._jobs.items()
+            if job.finished and job.finished_at is not None and job.finished_at < cutoff
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
+            self._saved_at.pop(job_id, None)
+        if not self.state_dir:
+            return
+        # State files of jobs run by other (possibly exited) workers expire by age.
+        for entry in os.scandir(self.state_dir):
+            if not entry.name.endswith(".json"):
+                continue
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+            except OSError:
+                pass
+
+
+def _process_alive(pid: int) -> bool:
+    if pid == os.getpid():
+        # Jobs of this process are in ``JobQueue._jobs``; a file naming this pid
+        # was left by an earlier process that had the same id.
+        return False
+    if os.name == "nt":
+        return _windows_process_alive(pid)
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _windows_process_alive(pid: int) -> bool:
+    # os.kill(pid, 0) would terminate the process on Windows; ask the kernel instead.
+    import ctypes  # noqa: PLC0415
+    from ctypes import wintypes  # noqa: PLC0415
+
+    process_query_limited_information = 0x1000
+    error_access_denied = 5
+    still_active = 259
+    kernel32 = ctypes.WinDLL("kernel32", use_last_error=True)
+    kernel32.OpenProcess.restype = wintypes.HANDLE
+    handle = kernel32.OpenProcess(process_query_limited_information, False, pid)
+    if not handle:
+        # Access denied means the process exists but belongs to someone else.
+        return ctypes.get_last_error() == error_access_denied
+    try:
+        exit_code = wintypes.DWORD()
+        if not kernel32.GetExitCodeProcess(handle, ctypes.byref(exit_code)):
+            return True
+        return exit_code.value == still_active
+    finally:
+        kernel32.CloseHandle(handle)
+
+
+_job_queue: Optional[JobQueue] = None
+
+
+def get_job_queue() -> JobQueue:
+    """Return the process-wide background job queue."""
+    global _job_queue
+    with _service_lock:
+        if _job_queue is None:
+            _job_queue = JobQueue(
+                app.config["JOB_WORKERS"],
+                app.config["JOB_MAX_PENDING"],
+                app.config["JOB_TTL_SECONDS"],
+                app.config["JOB_STATE_DIR"],
+            )
+        return _job_queue
+
+
+def _request_selection(source) -> ModelSelection:
+    """
+    Read a model selection from form fields, query args or a JSON object.
+
+    ``models`` lists the models to run and ``exclude_models`` those to skip;
+    both take model names, disease-code suffixes or tags, comma-separated or
+    as a list. Raises ValueError for terms that match nothing.
+    """
+    def terms(key):
+        if hasattr(source, "getlist"):
+            values = source.getlist(key)
+            return ",".join(values) if values else None
+        return source.get(key)
+
+    selection = ModelSelection.parse(terms("models"), terms("exclude_models"))
+    if selection:
+        get_scoring_engine().select(selection)
+    return selection
+
+
+def _request_top_k(source, key: str = "contributions") -> int:
+    """Parse the per-row top-k for feature contributions; 0 (the default) turns them off."""
+    raw = source.get(key) if source is not None else None
+    if raw in (None, ""):
+        return 0
+    try:
+        top_k = int(raw)
+    except (TypeError, ValueError):
+        raise ValueError(f"{key} must be an integer.") from None
+    if not 0 <= top_k <= app.config["CONTRIBUTIONS_MAX_K"]:
+        raise ValueError(f"{key} must be between 0 and {app.config['CONTRIBUTIONS_MAX_K']}.")
+    return top_k
+
+
+def _prediction_payload(
+    filename: str,
+    filepath: str,
+    result_filepath: str,
+    summary: dict,
+    run_info: dict,
+) -> dict:
+    return dict(
+        success=True,
+        message="File uploaded and predictions completed.",
+        filename=filename,
+        filepath=filepath,
+        prediction_file=os.path.basename(result_filepath),
+        prediction_summary=summary,
+        prediction_statistics=run_info.get("statistics"),
+        rows=run_info.get("rows"),
+        model_version=run_info.get("model_version"),
+        models_run=run_info.get("models_run", []),
+        contributions_file=(
+            os.path.basename(run_info["contributions_file"])
+            if run_info.get("contributions_file")
+            else None
+        ),
+        missing_features=run_info.get("missing_features", []),
+        store_run_id=run_info.get("store_run_id"),
+    )
 
-    original_filename = os.path.basename(filepath)
-    result_filename = f"predictions_{original_filename}"
-    result_filepath = os.path.join(user_dir, result_filename)
-    results.to_csv(result_filepath, index=False)
-    logging.info("Prediction file stored at %s", result_filepath)
 
-    summary = {
-        col: results[col].mean()
-        for col in results.columns
-        if col not in {"eid", "row_id"} and pd.api.types.is_numeric_dtype(results[col])
-    }
-    return result_filepath, summary
+def _run_prediction_job(job: PredictionJob) -> dict:
+    def progress(model_name: str, status: str) -> None:
+        job.models[model_name] = status
+        get_job_queue().save(job)
+
+    run_info: dict = {}
+    result_filepath, prediction_summary = predict_with_models(
+        job.filepath,
+        job.user_dir,
+        chunksize=app.config["STREAM_CHUNK_ROWS"] or None,
+        progress=progress,
+        output_format=job.output_format,
+        run_info=run_info,
+        selection=job.selection,
+        contributions=job.contributions,
+    )
+    _store_predictions(
+        os.path.basename(job.user_dir),
+        job.filepath,
+        result_filepath,
+        job.output_format,
+        run_info,
+    )
+    return _prediction_payload(
+        job.filename, job.filepath, result_filepath, prediction_summary, run_info
+    )
 
 
 @app.route("/api/login", methods=["POST"])
 def login_api():
-    """Handle file upload + LightGBM inference in one request."""
+    """
+    Handle file upload + LightGBM inference.
+
+    Inference runs inside the request unless ``async=1`` is posted (or
+    ASYNC_UPLOADS is on), in which case a job id is returned immediately.
+    ``models`` / ``exclude_models`` restrict which models run, and
+    ``contributions=k`` also saves each row's k strongest features per model.
+    """
     if "file" not in request.files:
         return jsonify(success=False, error="No file part detected."), 400
 
@@ -130,9 +563,30 @@ def login_api():
     if not allowed_file(file.filename):
         return jsonify(
             success=False,
-            error="Only Excel (.xlsx/.xls) and CSV files are supported.",
+            error="Only Excel (.xlsx/.xls), CSV, Parquet and Feather/Arrow files are supported.",
         ), 400
 
+    output_format = request.form.get("output_format", app.config["OUTPUT_FORMAT"]).strip().lower()
+    if output_format not in OUTPUT_FORMATS:
+        return jsonify(
+            success=False,
+            error=f"output_format must be one of: {', '.join(sorted(OUTPUT_FORMATS))}.",
+        ), 400
+    try:
+        check_output_options(
+            output_format,
+            app.config["OUTPUT_COMPRESSION"] or None,
+            app.config["OUTPUT_PRECISION"] or None,
+        )
+    except ValueError as err:
+        return jsonify(success=False, error=str(err)), 400
+
+    try:
+        selection = _request_selection(request.form)
+        contributions = _request_top_k(request.form)
+    except (ValueError, FileNotFoundError) as err:
+        return jsonify(success=False, error=str(err)), 400
+
     filename = secure_filename(file.filename)
     user_dir = os.path.join(app.config["UPLOAD_FOLDER"], username)
     os.makedirs(user_dir, exist_ok=True)
@@ -142,19 +596,205 @@ def login_api():
     file.save(filepath)
     logging.info("Uploaded file saved to %s", filepath)
 
+    async_flag = request.form.get("async", "").strip().lower()
+    if async_flag in {"1", "true", "yes"} or (app.config["ASYNC_UPLOADS"] and async_flag != "0"):
+        job = PredictionJob(
+            job_id=uuid.uuid4().hex,
+            filename=filename,
+            filepath=filepath,
+            user_dir=user_dir,
+            output_format=output_format,
+            selection=selection,
+            contributions=contributions,
+        )
+        try:
+            get_job_queue().submit(job, _run_prediction_job)
+        except JobQueueFull as err:
+            return jsonify(success=False, error=str(err)), 503
+        logging.info("Queued prediction job %s for %s", job.job_id, filepath)
+        return jsonify(
+            success=True,
+            message="File uploaded; predictions queued.",
+            filename=filename,
+            filepath=filepath,
+            job_id=job.job_id,
+            status_url=f"/api/jobs/{job.job_id}",
+            result_url=f"/api/jobs/{job.job_id}/result",
+        ), 202
+
+    run_info: dict = {}
     try:
-        result_filepath, prediction_summary = predict_with_models(filepath, user_dir)
+        result_filepath, prediction_summary = predict_with_models(
+            filepath,
+            user_dir,
+            chunksize=app.config["STREAM_CHUNK_ROWS"] or None,
+            output_format=output_format,
+            run_info=run_info,
+            selection=selection,
+            contributions=contributions,
+        )
     except Exception as err:  # noqa: BLE001
         logging.exception("Prediction failed for %s", filepath)
         return jsonify(success=False, error=f"Prediction failed: {err}"), 500
 
+    _store_predictions(username, filepath, result_filepath, output_format, run_info)
     return jsonify(
-        success=True,
-        message="File uploaded and predictions completed.",
-        filename=filename,
-        filepath=filepath,
-        prediction_file=os.path.basename(result_filepath),
-        prediction_summary=prediction_summary,
+        **_prediction_payload(filename, filepath, result_filepath, prediction_summary, run_info)
+    )
+
+
+@app.route("/api/score", methods=["POST"])
+def score_api():
+    """
+    Score JSON records in memory and return per-model probabilities.
+
+    Accepts a record, a list of records, or ``{"records": [...]}``; the latter
+    (or the query string) may add ``models`` / ``exclude_models`` and
+    ``top_k``, which adds each row's strongest features per model
+    (``contributions``) and across models (``top_proteins``). Models with a
+    reference distribution also report ``percentiles`` per record. Every
+    result carries the record's position as ``row_id`` and, if any record
+    has one, its ``eid`` as posted.
+    """
+    payload = request.get_json(silent=True)
+    options = payload if isinstance(payload, dict) and "records" in payload else request.args
+    try:
+        selection = _request_selection(options)
+        top_k = _request_top_k(options, "top_k")
+    except (ValueError, FileNotFoundError) as err:
+        return jsonify(success=False, error=str(err)), 400
+
+    records = payload
+    if isinstance(payload, dict) and "records" in payload:
+        records = payload["records"]
+    if isinstance(records, dict):
+        records = [records]
+    if not isinstance(records, list) or not records or not all(
+        isinstance(record, dict) for record in records
+    ):
+        return jsonify(success=False, error="Expected a JSON record or a list of records."), 400
+
+    frame = pd.DataFrame.from_records(records)
+    # Each record's own eid is echoed as posted (null where it has none);
+    # row_id is the record's position and is what results are matched on.
+    echo_eid = "eid" in frame.columns
+    try:
+        model_names, predictions, contributions = get_batcher().score(
+            frame,
+            timeout=app.config["SCORE_TIMEOUT_SECONDS"],
+            selection=selection,
+            top_k=top_k,
+        )
+    except Exception as err:  # noqa: BLE001
+        logging.exception("Scoring failed for %d JSON record(s)", len(records))
+        return jsonify(success=False, error=f"Scoring failed: {err}"), 500
+
+    engine = get_scoring_engine()
+    percentiles = engine.percentiles(
+        [model for model in engine.registry.models() if model.name in predictions], predictions
+    )
+
+    rows = []
+    for position, record in enumerate(records):
+        row = {"row_id": position + 1}
+        if echo_eid:
+            row["eid"] = record.get("eid")
+        for name in model_names:
+            values = predictions[name]
+            value = None if values is None else float(values[position])
+            row[name] = None if value is None or np.isnan(value) else value
+        if percentiles:
+            row["percentiles"] = {
+                name: (
+                    None
+                    if values is None or np.isnan(values[position])
+                    else round(float(values[position]), 2)
+                )
+                for name, values in percentiles.items()
+            }
+        if top_k:
+            per_model = {
+                name: [
+                    {"feature": feature, "contribution": contribution}
+                    for feature, contribution in rows_of_model[position]
+                ]
+                for name, rows_of_model in contributions.items()
+            }
+            row["contributions"] = per_model
+            row["top_proteins"] = rank_features(
+                (
+                    (item["feature"], item["contribution"])
+                    for items in per_model.values()
+                    for item in items
+                ),
+                top_k,
+            )
+        rows.append(row)
+
+    return jsonify(success=True, models=model_names, predictions=rows)
+
+
+@app.route("/api/jobs/<job_id>", methods=["GET"])
+def job_status(job_id):
+    """Report the status and per-model progress of a background prediction job."""
+    job = get_job_queue().get(job_id)
+    if job is None:
+        return jsonify(success=False, error="Unknown job id."), 404
+    return jsonify(success=True, **job.describe())
+
+
+@app.route("/api/jobs/<job_id>/result", methods=["GET"])
+def job_result(job_id):
+    """Return the prediction payload of a finished job (202 while it is still running)."""
+    job = get_job_queue().get(job_id)
+    if job is None:
+        return jsonify(success=False, error="Unknown job id."), 404
+    if job.status == "failed":
+        return jsonify(success=False, job_id=job_id, error=job.error), 500
+    if job.status != "succeeded":
+        return jsonify(success=False, job_id=job_id, status=job.status), 202
+    return jsonify(job_id=job_id, **job.result)
+
+
+@app.route("/api/models", methods=["GET"])
+def list_models():
+    """Report the resident model set and its version fingerprint."""
+    return jsonify(success=True, **get_model_registry().describe())
+
+
+def _participant_query(eid: str, query: Callable[[PredictionStore], list]):
+    store = get_prediction_store()
+    if store is None:
+        return jsonify(success=False, error="The prediction store is disabled."), 404
+    return jsonify(success=True, eid=eid, predictions=query(store))
+
+
+@app.route("/api/participants/<eid>/latest", methods=["GET"])
+def participant_latest(eid):
+    """Latest stored prediction of each model for one participant (``?model=`` narrows it)."""
+    return _participant_query(
+        eid, lambda store: store.latest(eid, model=request.args.get("model") or None)
+    )
+
+
+@app.route("/api/participants/<eid>/history", methods=["GET"])
+def participant_history(eid):
+    """
+    Every stored prediction for one participant, oldest first.
+
+    ``model`` narrows it to one model, ``since`` (Unix seconds) to recent
+    runs, and ``limit`` caps the rows returned (default 1000).
+    """
+    try:
+        since = float(request.args["since"]) if request.args.get("since") else None
+        limit = int(request.args.get("limit", "1000"))
+    except ValueError:
+        return jsonify(success=False, error="since and limit must be numbers."), 400
+    return _participant_query(
+        eid,
+        lambda store: store.history(
+            eid, model=request.args.get("model") or None, since=since, limit=limit
+        ),
     )
 
 
@@ -172,30 +812,73 @@ def download_file(username, filename):
 
 @app.route("/api/download-all/<username>", methods=["GET"])
 def download_all_files(username):
-    """Download all files for a user as a ZIP archive."""
+    """
+    Download all files for a user as a ZIP archive.
+
+    The archive is streamed as it is built; a finished archive is cached and
+    served directly until a file in the directory is added, removed or changed.
+    """
     user_dir = os.path.join(app.config["UPLOAD_FOLDER"], username)
     if not os.path.exists(user_dir):
         return jsonify(success=False, error="User directory not found."), 404
 
-    memory_file = io.BytesIO()
-    with zipfile.ZipFile(memory_file, "w", zipfile.ZIP_DEFLATED) as archive:
-        for root, _, files in os.walk(user_dir):
-            for filename in files:
-                file_path = os.path.join(root, filename)
-                arcname = os.path.relpath(file_path, start=user_dir)
-                archive.write(file_path, arcname=os.path.join(username, arcname))
-
-    memory_file.seek(0)
-    return send_file(
-        memory_file,
-        as_attachment=True,
-        download_name=f"{username}_files.zip",
+    download_name = f"{username}_files.zip"
+    entries = list_entries(user_dir, username)
+    if not app.config["ARCHIVE_CACHE_DIR"]:
+        body = iter_zip(entries)
+    else:
+        cache = ArchiveCache(app.config["ARCHIVE_CACHE_DIR"])
+        cached = cache.lookup(username, entries)
+        if cached is not None:
+            return send_file(
+                cached,
+                as_attachment=True,
+                download_name=download_name,
+                mimetype="application/zip",
+            )
+        body = cache.stream(username, entries)
+
+    return Response(
+        stream_with_context(body),
         mimetype="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="{download_name}"'},
     )
 
 
-if __name__ == "__main__":
+_ready = threading.Event()
+
+
+@app.route("/api/ready", methods=["GET"])
+def readiness():
+    """Readiness probe: 200 only once the models are resident in this process."""
+    if not _ready.is_set():
+        return jsonify(success=False, ready=False), 503
+    registry = get_model_registry()
+    return jsonify(success=True, ready=True, pid=os.getpid(), version=registry.version)
+
+
+def create_app(model_dir: Optional[str] = None, preload_models: bool = True) -> Flask:
+    """
+    Configure the service and make its models resident before serving.
+
+    Under a pre-fork server (see gunicorn.conf.py) this runs once in the
+    master, so every worker inherits the parsed boosters and preprocessing
+    schema copy-on-write instead of loading its own.
+    """
+    if model_dir is not None:
+        app.config["MODEL_DIR"] = str(model_dir)
     if not Path(app.config["MODEL_DIR"]).exists():
         logging.warning("Model directory does not exist: %s", app.config["MODEL_DIR"])
 
+    if preload_models:
+        registry = get_scoring_engine().warm_up()
+        if registry.models():
+            _ready.set()
+        else:
+            logging.warning("No models loaded from %s; readiness stays red", registry.model_dir)
+    return app
+
+
+if __name__ == "__main__":
+    create_app()
     app.run(host="0.0.0.0", port=5000, debug=True)
@@ -0,0 +1,146 @@
+"""Streamed ZIP archives of a user's directory, with an on-disk cache of finished archives."""
+
+from __future__ import annotations
+
+import hashlib
+import logging
+import os
+import re
+import tempfile
+import zipfile
+from typing import Iterator, List, Optional, Tuple
+
+# Members that are already compressed are stored as-is instead of deflated again.
+STORED_EXTENSIONS = {
+    ".xlsx", ".docx", ".pptx", ".pdf", ".parquet", ".zip", ".gz", ".zst", ".bz2", ".xz",
+    ".png", ".jpg", ".jpeg", ".gif", ".webp",
+}
+COPY_BLOCK_SIZE = 1 << 20
+
+ArchiveEntry = Tuple[str, str, int, int]  # path, arcname, size, mtime_ns
+
+
+class _StreamSink:
+    """Unseekable file object that buffers what ``zipfile`` writes until it is drained."""
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+        self._position = 0
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def list_entries(directory: str, prefix: str) -> List[ArchiveEntry]:
+    """Files under ``directory`` (hidden entries skipped) with their archive names, sorted."""
+    entries = []
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = sorted(name for name in dirs if not name.startswith("."))
+        for filename in sorted(files):
+            if filename.startswith("."):
+                continue
+            path = os.path.join(root, filename)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            arcname = os.path.join(prefix, os.path.relpath(path, start=directory))
+            entries.append((path, arcname, stat.st_size, stat.st_mtime_ns))
+    return entries
+
+
+def iter_zip(entries: List[ArchiveEntry]) -> Iterator[bytes]:
+    """
+    Yield a ZIP archive of ``entries`` piece by piece.
+
+    Members are read and compressed in 1 MiB blocks, and every block is
+    yielded as soon as ``zipfile`` emits it, so memory stays bounded by the
+    block size whatever the archive size.
+    """
+    sink = _StreamSink()
+    with zipfile.ZipFile(sink, "w") as archive:
+        for path, arcname, size, _ in entries:
+            info = zipfile.ZipInfo.from_file(path, arcname=arcname)
+            stored = os.path.splitext(path)[1].lower() in STORED_EXTENSIONS
+            info.compress_type = zipfile.ZIP_STORED if stored else zipfile.ZIP_DEFLATED
+            with open(path, "rb") as source, archive.open(
+                info, "w", force_zip64=size >= zipfile.ZIP64_LIMIT
+            ) as member:
+                for block in iter(lambda: source.read(COPY_BLOCK_SIZE), b""):
+                    member.write(block)
+                    data = sink.drain()
+                    if data:
+                        yield data
+            data = sink.drain()
+            if data:
+                yield data
+    yield sink.drain()
+
+
+class ArchiveCache:
+    """
+    Finished archives keyed on a directory's file listing (names, sizes, mtimes).
+
+    Only the newest archive per owner is kept. An archive is written to the
+    cache while it streams and only becomes visible once it is complete.
+    """
+
+    def __init__(self, root: str):
+        self.root = str(root)
+
+    @staticmethod
+    def _owner(owner: str) -> str:
+        return re.sub(r"[^A-Za-z0-9_.-]", "_", owner).lstrip(".") or "_"
+
+    def _path(self, owner: str, entries: List[ArchiveEntry]) -> str:
+        digest = hashlib.sha256()
+        for _, arcname, size, mtime_ns in entries:
+            digest.update(f"{arcname}\0{size}\0{mtime_ns}\n".encode("utf-8"))
+        return os.path.join(self.root, self._owner(owner), f"{digest.hexdigest()[:24]}.zip")
+
+    def lookup(self, owner: str, entries: List[ArchiveEntry]) -> Optional[str]:
+        path = self._path(owner, entries)
+        return path if os.path.exists(path) else None
+
+    def stream(self, owner: str, entries: List[ArchiveEntry]) -> Iterator[bytes]:
+        """Yield the archive while saving it; a download cut short leaves nothing behind."""
+        target = self._path(owner, entries)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        handle, partial = tempfile.mkstemp(prefix=".partial-", dir=os.path.dirname(target))
+        completed = False
+        try:
+            with os.fdopen(handle, "wb") as cache_file:
+                for data in iter_zip(entries):
+                    cache_file.write(data)
+                    yield data
+            os.replace(partial, target)
+            completed = True
+            self._drop_older(target)
+        finally:
+            if not completed:
+                try:
+                    os.unlink(partial)
+                except OSError:
+                    pass
+
+    @staticmethod
+    def _drop_older(keep: str) -> None:
+        for entry in os.scandir(os.path.dirname(keep)):
+            if entry.name.endswith(".zip") and entry.path != keep:
+                try:
+                    os.unlink(entry.path)
+                except OSError:
+                    logging.warning("Could not remove stale archive %s", entry.path)
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""Measure how long predict_cli.py takes to start, and which heavy modules it imports."""
+
+from __future__ import annotations
+
+import argparse
+import json
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent
+# Modules the CLI must not import before it has a file to score.
+HEAVY_MODULES = ("flask", "werkzeug", "lightgbm", "pandas", "numpy", "pyarrow")
+PROBE = (
+    "import json, sys; import predict_cli; "
+    "print(json.dumps(sorted(m for m in {heavy!r} if m in sys.modules)))"
+)
+
+
+def _run(args, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(args, cwd=BASE_DIR, check=True, capture_output=True)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def run_cli() -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per measurement (default: 5).")
+    parser.add_argument(
+        "--budget-ms",
+        type=float,
+        default=None,
+        help="Exit non-zero when `predict_cli.py --help` takes longer than this.",
+    )
+    args = parser.parse_args()
+
+    baseline_s = _run([sys.executable, "-c", "pass"], args.repeat)
+    import_s = _run([sys.executable, "-c", "import predict_cli"], args.repeat)
+    help_s = _run([sys.executable, "predict_cli.py", "--help"], args.repeat)
+    probe = subprocess.run(
+        [sys.executable, "-c", PROBE.format(heavy=HEAVY_MODULES)],
+        cwd=BASE_DIR,
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    loaded = json.loads(probe.stdout)
+
+    print(f"interpreter          {baseline_s * 1e3:8.1f} ms")
+    print(f"import predict_cli   {import_s * 1e3:8.1f} ms")
+    print(f"predict_cli --help   {help_s * 1e3:8.1f} ms")
+    print(f"heavy modules loaded {', '.join(loaded) or 'none'}")
+
+    failed = bool(loaded)
+    if args.budget_ms is not None and help_s * 1e3 > args.budget_ms:
+        print(f"[FAIL] startup exceeds the {args.budget_ms:.0f} ms budget")
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(run_cli())
@@ -0,0 +1,46 @@
+"""Pre-fork production settings for the LightGBM service (``gunicorn -c gunicorn.conf.py wsgi:app``)."""
+
+import gc
+import multiprocessing
+import os
+
+bind = os.getenv("MEDLI_BIND", "0.0.0.0:5000")
+workers = int(os.getenv("MEDLI_WORKERS", str(multiprocessing.cpu_count())))
+worker_class = "gthread"
+threads = int(os.getenv("MEDLI_WORKER_THREADS", "4"))
+
+# Load wsgi:app (and with it every model) in the master before forking so
+# the workers share the model memory copy-on-write.
+preload_app = True
+
+# Graceful recycling: restart a worker after a jittered number of requests,
+# letting in-flight requests finish within graceful_timeout. Background jobs
+# (async uploads) are drained in worker_exit below, for up to job_drain_timeout;
+# their state lives in MEDLI_JOB_STATE_DIR so every worker answers job polls.
+max_requests = int(os.getenv("MEDLI_MAX_REQUESTS", "2000"))
+max_requests_jitter = int(os.getenv("MEDLI_MAX_REQUESTS_JITTER", "200"))
+graceful_timeout = int(os.getenv("MEDLI_GRACEFUL_TIMEOUT", "60"))
+timeout = int(os.getenv("MEDLI_TIMEOUT", "300"))
+job_drain_timeout = int(os.getenv("MEDLI_JOB_DRAIN_TIMEOUT", "1800"))
+
+# Split the cores between workers so per-worker LightGBM threads do not
+# oversubscribe the node. Read by the app at import time, i.e. after this file.
+os.environ.setdefault("MEDLI_CPU_BUDGET", str(max(1, multiprocessing.cpu_count() // workers)))
+
+
+def when_ready(server):
+    # Move everything allocated while preloading into the permanent
+    # generation so the workers' garbage collector never writes to (and
+    # un-shares) those pages.
+    gc.collect()
+    gc.freeze()
+    server.log.info("Models preloaded; forking %d workers", workers)
+
+
+def worker_exit(server, worker):
+    # A recycled worker would otherwise take its running background jobs
+    # down with it; finish them first, heartbeating so the master's
+    # ``timeout`` does not kill the worker meanwhile.
+    from app_lightgbm_service import get_job_queue  # noqa: PLC0415
+
+    get_job_queue().drain(job_drain_timeout, heartbeat=worker.notify)
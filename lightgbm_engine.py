@@ -0,0 +1,2515 @@
+"""
+LightGBM scoring engine shared by the Flask service and the CLI.
+
+The module only imports the standard library at load time; NumPy, pandas,
+LightGBM and pyarrow are imported when the first model is loaded or the
+first table is scored, so tools that merely import it start quickly.
+"""
+
+from __future__ import annotations
+
+import dataclasses
+import glob
+import hashlib
+import io
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import (
+    IO,
+    TYPE_CHECKING,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
+
+from prediction_cache import PredictionCache, file_digest
+
+if TYPE_CHECKING:
+    import numpy as np
+    import pandas as pd
+
+    from preprocessing import PreprocessingSchema
+    from reference_index import ReferenceIndex
+
+BASE_DIR = Path(__file__).resolve().parent
+SERVER_MODEL_DIR = Path("17_models")
+LOCAL_MODEL_DIR = BASE_DIR / "models"
+DEFAULT_CACHE_DIR = BASE_DIR / ".cache" / "predictions"
+
+# Columns read from every input besides the model features.
+ID_COLUMNS = ("eid", "sex")
+PARQUET_EXTENSIONS = (".parquet",)
+ARROW_EXTENSIONS = (".feather", ".arrow")
+NPY_EXTENSIONS = (".npy",)
+INPUT_EXTENSIONS = (
+    (".csv", ".xlsx", ".xls") + PARQUET_EXTENSIONS + ARROW_EXTENSIONS + NPY_EXTENSIONS
+)
+# Rows per block when scoring a memory-mapped .npy matrix without --chunksize.
+NPY_BLOCK_ROWS = 65536
+OUTPUT_FORMATS = {"csv": ".csv", "parquet": ".parquet", "feather": ".feather"}
+# Optional output compression and the suffix it adds to CSV prediction files.
+COMPRESSIONS = {"gzip": ".gz", "zstd": ".zst"}
+CSV_EXTENSIONS = (".csv", ".csv.gz", ".csv.zst")
+GZIP_LEVEL = 6
+# Optional {tag: [model name or name suffix, ...]} file in the model directory.
+MODEL_TAGS_FILENAME = "model_tags.json"
+# Optional reference-population quantiles (built by reference_index.py).
+REFERENCE_FILENAME = "reference_quantiles.npz"
+PERCENTILE_SUFFIX = "_percentile"
+# Streaming score statistics: log-spaced bins (DDSketch layout) for quantiles
+# with bounded relative error, plus exact histogram and threshold counts.
+SUMMARY_RANGE = (0.0, 1.0)
+SUMMARY_RELATIVE_ACCURACY = 0.005
+SUMMARY_MIN_SCORE = 1e-9
+SUMMARY_HISTOGRAM_BINS = 20
+SUMMARY_QUANTILES = (0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99)
+SUMMARY_THRESHOLDS = (0.01, 0.05, 0.1, 0.2, 0.5)
+# Hidden sidecar next to each prediction file: ".<prediction file>.manifest.json".
+MANIFEST_SUFFIX = ".manifest.json"
+
+
+def default_model_dir() -> str:
+    """MEDLI_MODEL_DIR, else ``17_models`` when present, else ``models`` next to this file."""
+    configured = os.getenv("MEDLI_MODEL_DIR")
+    if configured:
+        return configured
+    return str(SERVER_MODEL_DIR) if SERVER_MODEL_DIR.exists() else str(LOCAL_MODEL_DIR)
+
+
+@dataclass(frozen=True)
+class EngineSettings:
+    """Everything a :class:`ScoringEngine` needs; the model directory is always explicit."""
+
+    model_dir: str
+    cpu_budget: int = 1
+    schema_path: Optional[str] = None
+    cache_dir: Optional[str] = None
+    cache_max_bytes: int = 0
+
+    @classmethod
+    def from_env(cls, model_dir: Optional[str] = None) -> "EngineSettings":
+        return cls(
+            model_dir=str(model_dir or default_model_dir()),
+            cpu_budget=int(os.getenv("MEDLI_CPU_BUDGET", str(os.cpu_count() or 1))),
+            schema_path=os.getenv("MEDLI_PREPROCESSING_SCHEMA") or None,
+            cache_dir=os.getenv("MEDLI_PREDICTION_CACHE_DIR", str(DEFAULT_CACHE_DIR)),
+            cache_max_bytes=int(os.getenv("MEDLI_PREDICTION_CACHE_MAX_BYTES", str(1 << 30))),
+        )
+
+
+@dataclass
+class LoadedModel:
+    """A booster held in memory together with the file state it was loaded from."""
+
+    name: str
+    path: str
+    mtime: float
+    size: int
+    sha256: str
+    loaded_at: float
+    booster: Optional[object] = None
+    feature_names: List[str] = field(default_factory=list)
+    error: Optional[str] = None
+
+    def describe(self) -> dict:
+        return {
+            "name": self.name,
+            "file": os.path.basename(self.path),
+            "sha256": self.sha256,
+            "mtime": self.mtime,
+            "loaded_at": self.loaded_at,
+            "num_features": len(self.feature_names),
+            "loaded": self.booster is not None,
+            "error": self.error,
+        }
+
+
+def _file_sha256(path: str) -> str:
+    return file_digest(path)
+
+
+def _column_selector(index: np.ndarray):
+    """Use a slice (a view) when the columns are a contiguous run, else the index array."""
+    import numpy as np  # noqa: PLC0415
+
+    if len(index) and np.array_equal(index, np.arange(index[0], index[0] + len(index))):
+        return slice(int(index[0]), int(index[0]) + len(index))
+    return index
+
+
+@dataclass
+class FeatureLayout:
+    """
+    Column layout of the feature-union matrix shared by every model.
+
+    ``features`` is the union of all model features in first-seen order and
+    ``model_columns`` maps each model to the columns it reads, in its own
+    ``feature_name()`` order.
+    """
+
+    version: str
+    features: List[str]
+    model_columns: Dict[str, object]
+
+    @classmethod
+    def from_models(cls, models: List[LoadedModel], version: str = "") -> "FeatureLayout":
+        import numpy as np  # noqa: PLC0415
+
+        positions: Dict[str, int] = {}
+        for model in models:
+            for feature in model.feature_names:
+                positions.setdefault(feature, len(positions))
+        model_columns = {
+            model.name: _column_selector(
+                np.fromiter(
+                    (positions[f] for f in model.feature_names),
+                    dtype=np.intp,
+                    count=len(model.feature_names),
+                )
+            )
+            for model in models
+        }
+        return cls(version=version, features=list(positions), model_columns=model_columns)
+
+
+def _model_set_version(digests: Dict[str, str]) -> str:
+    digest = hashlib.sha256()
+    for name in sorted(digests):
+        digest.update(f"{name}:{digests[name]}\n".encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+
+class ModelRegistry:
+    """
+    Process-wide cache of the LightGBM boosters found in a model directory.
+
+    Boosters are parsed once and kept resident. ``refresh`` only stats the
+    model files; a file is re-hashed when its mtime or size moved and re-parsed
+    only when its content hash actually changed.
+    """
+
+    def __init__(self, model_dir: str):
+        self.model_dir = str(model_dir)
+        self._models: Dict[str, LoadedModel] = {}
+        self._layouts: Dict[Tuple[str, ...], FeatureLayout] = {}
+        self._layout_version = ""
+        self._tags_key: Optional[float] = None
+        self._tags: Dict[str, List[str]] = {}
+        self._digests: Dict[str, Tuple[float, int, str]] = {}
+        self._lock = threading.RLock()
+
+    def _digest(self, model_file: str, stat: os.stat_result) -> str:
+        """SHA-256 of a model file, re-read only when its mtime or size moved."""
+        known = self._digests.get(model_file)
+        if known is not None and known[:2] == (stat.st_mtime, stat.st_size):
+            return known[2]
+        sha256 = _file_sha256(model_file)
+        self._digests[model_file] = (stat.st_mtime, stat.st_size, sha256)
+        return sha256
+
+    def digests(self) -> Dict[str, str]:
+        """
+        Content hash of every model file by model name, without parsing any booster.
+
+        Lets a prediction-cache hit be served before the models are loaded.
+        """
+        with self._lock:
+            found = {}
+            for model_file in sorted(glob.glob(os.path.join(self.model_dir, "*.model"))):
+                try:
+                    stat = os.stat(model_file)
+                except OSError:
+                    continue
+                found[Path(model_file).stem] = self._digest(model_file, stat)
+            return found
+
+    def refresh(self) -> List[str]:
+        """Bring the registry in line with the model directory and return the reloaded names."""
+        with self._lock:
+            model_files = sorted(glob.glob(os.path.join(self.model_dir, "*.model")))
+            reloaded = []
+            seen = set()
+            for model_file in model_files:
+                name = Path(model_file).stem
+                seen.add(name)
+                try:
+                    stat = os.stat(model_file)
+                except OSError:
+                    continue
+
+                current = self._models.get(name)
+                if (
+                    current is not None
+                    and current.path == model_file
+                    and current.mtime == stat.st_mtime
+                    and current.size == stat.st_size
+                ):
+                    continue
+
+                sha256 = self._digest(model_file, stat)
+                if current is not None and current.sha256 == sha256 and current.error is None:
+                    current.path = model_file
+                    current.mtime = stat.st_mtime
+                    current.size = stat.st_size
+                    continue
+
+                self._models[name] = self._load(name, model_file, stat, sha256)
+                reloaded.append(name)
+
+            for name in set(self._models) - seen:
+                logging.info("Model %s removed from %s", name, self.model_dir)
+                del self._models[name]
+
+            if reloaded:
+                logging.info(
+                    "Loaded %d model(s) from %s: %s",
+                    len(reloaded),
+                    self.model_dir,
+                    ", ".join(reloaded),
+                )
+            return reloaded
+
+    @staticmethod
+    def _load(name: str, model_file: str, stat: os.stat_result, sha256: str) -> LoadedModel:
+        entry = LoadedModel(
+            name=name,
+            path=model_file,
+            mtime=stat.st_mtime,
+            size=stat.st_size,
+            sha256=sha256,
+            loaded_at=time.time(),
+        )
+        try:
+            import lightgbm as lgb  # noqa: PLC0415
+
+            entry.booster = lgb.Booster(model_file=model_file)
+            entry.feature_names = list(entry.booster.feature_name())
+        except Exception as err:  # noqa: BLE001
+            logging.exception("Failed to load model %s: %s", name, err)
+            entry.error = str(err)
+        return entry
+
+    def models(self) -> List[LoadedModel]:
+        """Return the current model set, ordered by name."""
+        with self._lock:
+            return [self._models[name] for name in sorted(self._models)]
+
+    @property
+    def version(self) -> str:
+        """Fingerprint of the loaded model set (names + content hashes)."""
+        return _model_set_version({model.name: model.sha256 for model in self.models()})
+
+    def layout(self, models: Optional[List[LoadedModel]] = None) -> FeatureLayout:
+        """
+        Return the feature layout for ``models`` (default: all of them).
+
+        Layouts are cached per model subset and rebuilt when the model set changes.
+        """
+        with self._lock:
+            version = self.version
+            if self._layout_version != version:
+                self._layouts = {}
+                self._layout_version = version
+            selected = self.models() if models is None else models
+            key = tuple(model.name for model in selected)
+            layout = self._layouts.get(key)
+            if layout is None:
+                layout = self._layouts[key] = FeatureLayout.from_models(selected, version)
+            return layout
+
+    def tags(self) -> Dict[str, List[str]]:
+        """Model tags from ``model_tags.json``, reloaded when the file changes."""
+        path = os.path.join(self.model_dir, MODEL_TAGS_FILENAME)
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return {}
+        with self._lock:
+            if self._tags_key != mtime:
+                try:
+                    with open(path, "r", encoding="utf-8") as handle:
+                        data = json.load(handle)
+                    self._tags = {
+                        str(tag): [str(term) for term in terms] for tag, terms in data.items()
+                    }
+                except (OSError, ValueError, AttributeError, TypeError):
+                    logging.exception("Ignoring unreadable model tags file %s", path)
+                    self._tags = {}
+                self._tags_key = mtime
+            return self._tags
+
+    def describe(self) -> dict:
+        models = self.models()
+        return {
+            "model_dir": self.model_dir,
+            "version": self.version,
+            "count": len(models),
+            "models": [model.describe() for model in models],
+            "tags": self.tags(),
+        }
+
+
+def _split_terms(value) -> Tuple[str, ...]:
+    """Accept None, a comma-separated string or a list of strings."""
+    if not value:
+        return ()
+    if isinstance(value, str):
+        value = value.split(",")
+    return tuple(dict.fromkeys(str(term).strip() for term in value if str(term).strip()))
+
+
+def _matches(name: str, term: str, tags: Dict[str, List[str]]) -> bool:
+    if term in tags:
+        return any(_matches(name, member, {}) for member in tags[term])
+    return name == term or name.endswith("_" + term)
+
+
+@dataclass(frozen=True)
+class ModelSelection:
+    """
+    Which resident models a request runs.
+
+    Each term is a model name, an underscore-delimited suffix of one (such
+    as the disease code ``I10`` of ``model_I10``) or a tag from
+    ``model_tags.json``. An empty ``include`` selects every model;
+    ``exclude`` is applied afterwards.
+    """
+
+    include: Tuple[str, ...] = ()
+    exclude: Tuple[str, ...] = ()
+
+    @classmethod
+    def parse(cls, include=None, exclude=None) -> "ModelSelection":
+        return cls(_split_terms(include), _split_terms(exclude))
+
+    def __bool__(self) -> bool:
+        return bool(self.include or self.exclude)
+
+    def apply(self, models: List[LoadedModel], tags: Dict[str, List[str]]) -> List[LoadedModel]:
+        """Return the selected models; unknown terms and empty selections raise ValueError."""
+        selected = set(self.names([model.name for model in models], tags))
+        return [model for model in models if model.name in selected]
+
+    def names(self, names: List[str], tags: Dict[str, List[str]]) -> List[str]:
+        """Same as :meth:`apply` for bare model names."""
+        unknown = [
+            term
+            for term in self.include + self.exclude
+            if term not in tags and not any(_matches(name, term, {}) for name in names)
+        ]
+        if unknown:
+            raise ValueError(f"Unknown model or tag: {', '.join(unknown)}")
+        selected = [
+            name
+            for name in names
+            if (not self.include or any(_matches(name, t, tags) for t in self.include))
+            and not any(_matches(name, t, tags) for t in self.exclude)
+        ]
+        if not selected:
+            raise ValueError("The model selection matches no models.")
+        return selected
+
+
+class InferenceScheduler:
+    """
+    Run the models of one request concurrently within a shared CPU budget.
+
+    LightGBM releases the GIL while predicting, so a thread pool is enough to
+    overlap models. Each request is granted ``cpu_budget // active_requests``
+    cores when it starts; those cores are spread over its worker threads and
+    passed to every booster as ``num_threads`` so concurrent requests do not
+    oversubscribe the machine.
+    """
+
+    def __init__(self, cpu_budget: int):
+        self.cpu_budget = max(1, int(cpu_budget))
+        self._active = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _reserve(self) -> Iterator[int]:
+        with self._lock:
+            self._active += 1
+            share = max(1, self.cpu_budget // self._active)
+        try:
+            yield share
+        finally:
+            with self._lock:
+                self._active -= 1
+
+    def run(
+        self,
+        models: List[LoadedModel],
+        task: Callable[[LoadedModel, int], object],
+    ) -> Dict[str, object]:
+        """Call ``task(model, num_threads)`` for every model and return results by model name."""
+        if not models:
+            return {}
+        with self._reserve() as share:
+            workers = min(len(models), share)
+            num_threads = max(1, share // workers)
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="lgb-predict") as pool:
+                futures = {model.name: pool.submit(task, model, num_threads) for model in models}
+                return {name: future.result() for name, future in futures.items()}
+
+
+def _prepare_results_frame(new_data: pd.DataFrame, first_row: int = 0) -> pd.DataFrame:
+    """Ensure we always have an ID column to anchor predictions."""
+    import numpy as np  # noqa: PLC0415
+    import pandas as pd  # noqa: PLC0415
+
+    if "eid" in new_data.columns:
+        return pd.DataFrame({"eid": new_data["eid"].to_numpy(copy=True)})
+
+    return pd.DataFrame({"row_id": np.arange(first_row + 1, first_row + len(new_data) + 1)})
+
+
+def _require_pyarrow():
+    try:
+        import pyarrow  # noqa: PLC0415
+    except ImportError as err:
+        raise RuntimeError("Parquet/Arrow support requires the 'pyarrow' package.") from err
+    return pyarrow
+
+
+def _arrow_to_pandas(table) -> pd.DataFrame:
+    # split_blocks keeps one block per column, so numeric columns are handed
+    # over without consolidation copies and reach preprocessing as-is.
+    return table.to_pandas(split_blocks=True, self_destruct=True)
+
+
+def _iter_arrow_frames(
+    filepath: str,
+    chunksize: Optional[int],
+    columns: Optional[List[str]],
+) -> Iterator[pd.DataFrame]:
+    pa = _require_pyarrow()
+    lower = filepath.lower()
+    if lower.endswith(PARQUET_EXTENSIONS):
+        import pyarrow.parquet as pq  # noqa: PLC0415
+
+        parquet_file = pq.ParquetFile(filepath, memory_map=True)
+        wanted = set(columns or ())
+        names = parquet_file.schema_arrow.names
+        selected = [name for name in names if name in wanted] if columns else None
+        if chunksize:
+            for batch in parquet_file.iter_batches(batch_size=chunksize, columns=selected):
+                yield _arrow_to_pandas(pa.Table.from_batches([batch]))
+        else:
+            yield _arrow_to_pandas(parquet_file.read(columns=selected))
+        return
+
+    with pa.memory_map(filepath, "r") as source:
+        reader = pa.ipc.open_file(source)
+        wanted = set(columns or ())
+        names = reader.schema.names
+        selected = [name for name in names if name in wanted] if columns else names
+        if not chunksize:
+            yield _arrow_to_pandas(reader.read_all().select(selected))
+            return
+        for index in range(reader.num_record_batches):
+            table = pa.Table.from_batches([reader.get_batch(index)]).select(selected)
+            for offset in range(0, table.num_rows, chunksize):
+                yield _arrow_to_pandas(table.slice(offset, chunksize))
+
+
+def _iter_input_frames(
+    filepath: str,
+    chunksize: Optional[int] = None,
+    columns: Optional[List[str]] = None,
+    float_columns: Optional[List[str]] = None,
+) -> Iterator[pd.DataFrame]:
+    """
+    Yield the uploaded table whole, or in row chunks of ``chunksize``.
+
+    CSV, Parquet and Feather/Arrow input can be chunked. When ``columns``
+    is given, only those columns are parsed; every other column is skipped
+    by the reader itself. CSV columns in ``float_columns`` are parsed as
+    float32.
+    """
+    import pandas as pd  # noqa: PLC0415
+
+    lower = filepath.lower()
+    if lower.endswith(PARQUET_EXTENSIONS + ARROW_EXTENSIONS):
+        yield from _iter_arrow_frames(filepath, chunksize, columns)
+        return
+
+    wanted = set(columns) if columns else None
+    usecols = (lambda name: name in wanted) if wanted is not None else None
+
+    if lower.endswith(CSV_EXTENSIONS):
+        yield from _iter_csv_frames(filepath, chunksize, usecols, float_columns)
+        return
+
+    if chunksize:
+        logging.info("Excel input cannot be streamed; reading %s in one pass", filepath)
+    yield pd.read_excel(filepath, usecols=usecols)
+
+
+def _npy_sidecar(filepath: str, kind: str) -> str:
+    """``cohort.npy`` -> ``cohort.columns.txt`` / ``cohort.ids.txt``."""
+    return f"{os.path.splitext(filepath)[0]}.{kind}.txt"
+
+
+def _read_lines(path: str) -> List[str]:
+    with open(path, "r", encoding="utf-8") as handle:
+        return [line.strip() for line in handle if line.strip()]
+
+
+def _open_npy(filepath: str) -> Tuple[np.ndarray, List[str], Optional[np.ndarray]]:
+    """
+    Map a 2-D ``.npy`` feature matrix read-only and load its sidecars.
+
+    ``<stem>.columns.txt`` (required) names the matrix columns, one per line;
+    ``<stem>.ids.txt`` (optional) holds one participant ``eid`` per row.
+    """
+    import numpy as np  # noqa: PLC0415
+
+    matrix = np.load(filepath, mmap_mode="r", allow_pickle=False)
+    if matrix.ndim != 2:
+        raise ValueError(f"{filepath} must hold a 2-D matrix, got shape {matrix.shape}.")
+
+    columns_path = _npy_sidecar(filepath, "columns")
+    if not os.path.exists(columns_path):
+        raise FileNotFoundError(f"{filepath} needs a column-name sidecar: {columns_path}")
+    columns = _read_lines(columns_path)
+    if len(columns) != matrix.shape[1]:
+        raise ValueError(
+            f"{columns_path} names {len(columns)} columns; the matrix has {matrix.shape[1]}."
+        )
+
+    ids = None
+    ids_path = _npy_sidecar(filepath, "ids")
+    if os.path.exists(ids_path):
+        labels = _read_lines(ids_path)
+        if len(labels) != matrix.shape[0]:
+            raise ValueError(
+                f"{ids_path} has {len(labels)} ids; the matrix has {matrix.shape[0]} rows."
+            )
+        try:
+            ids = np.asarray(labels, dtype=np.int64)
+        except ValueError:
+            ids = np.asarray(labels, dtype=object)
+    return matrix, columns, ids
+
+
+def _input_paths(filepath: str) -> List[str]:
+    """An input file, plus the sidecars of a ``.npy`` matrix."""
+    if not filepath.lower().endswith(NPY_EXTENSIONS):
+        return [filepath]
+    return [filepath, _npy_sidecar(filepath, "columns"), _npy_sidecar(filepath, "ids")]
+
+
+def _input_digest(filepath: str) -> str:
+    """Content hash of an input, including the sidecars of a ``.npy`` matrix."""
+    if not filepath.lower().endswith(NPY_EXTENSIONS):
+        return file_digest(filepath)
+    digest = hashlib.sha256()
+    for path in _input_paths(filepath):
+        digest.update((file_digest(path) if os.path.exists(path) else "-").encode("ascii"))
+    return digest.hexdigest()
+
+
+def _input_stat(filepath: str) -> List[Optional[List[int]]]:
+    """[size, mtime_ns] of an input and its sidecars (None where absent); no file is read."""
+    stats: List[Optional[List[int]]] = []
+    for path in _input_paths(filepath):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            stats.append(None)
+        else:
+            stats.append([stat.st_size, stat.st_mtime_ns])
+    return stats
+
+
+def _iter_csv_frames(
+    filepath: Union[str, IO[bytes]],
+    chunksize: Optional[int],
+    usecols: Optional[Callable[[str], bool]],
+    float_columns: Optional[List[str]],
+) -> Iterator[pd.DataFrame]:
+    import numpy as np  # noqa: PLC0415
+    import pandas as pd  # noqa: PLC0415
+
+    # Whole-file reads declare numeric model features float32 so the parser
+    # skips type inference; a file with non-numeric text in a feature column
+    # is re-read with inferred types (and coerced during preprocessing).
+    # Chunked reads cannot restart once a chunk has been yielded, so they
+    # always infer types and narrow the numeric feature columns per chunk.
+    if chunksize:
+        for chunk in pd.read_csv(filepath, chunksize=chunksize, usecols=usecols):
+            yield _narrow_float_columns(chunk, float_columns)
+        return
+
+    dtype = {name: np.float32 for name in float_columns} if float_columns else None
+    try:
+        frame = pd.read_csv(filepath, usecols=usecols, dtype=dtype)
+    except (ValueError, TypeError):
+        if dtype is None:
+            raise
+        logging.warning(
+            "Non-numeric feature values in %s; re-reading with inferred dtypes", filepath
+        )
+        if hasattr(filepath, "seek"):
+            filepath.seek(0)
+        frame = pd.read_csv(filepath, usecols=usecols)
+    yield frame
+
+
+def _narrow_float_columns(
+    chunk: pd.DataFrame, float_columns: Optional[List[str]]
+) -> pd.DataFrame:
+    """Cast the numeric ones of ``float_columns`` to float32; text columns stay for coercion."""
+    if not float_columns:
+        return chunk
+    numeric = {
+        name: "float32"
+        for name in float_columns
+        if name in chunk.columns and chunk[name].dtype.kind in "fiub"
+    }
+    return chunk.astype(numeric) if numeric else chunk
+
+
+def _require_zstandard():
+    try:
+        import zstandard  # noqa: PLC0415
+    except ImportError as err:
+        raise RuntimeError("zstd-compressed CSV output requires the 'zstandard' package.") from err
+    return zstandard
+
+
+def _open_csv_output(path: str, compression: Optional[str]) -> IO[str]:
+    if compression == "gzip":
+        import gzip  # noqa: PLC0415
+
+        return gzip.open(path, "wt", encoding="utf-8", newline="", compresslevel=GZIP_LEVEL)
+    if compression == "zstd":
+        return _require_zstandard().open(path, "wt", encoding="utf-8", newline="")
+    return open(path, "w", encoding="utf-8", newline="")
+
+
+def _open_table_writer(
+    path: str, output_format: str, schema, compression: Optional[str] = None
+):
+    pa = _require_pyarrow()
+    if output_format == "parquet":
+        import pyarrow.parquet as pq  # noqa: PLC0415
+
+        return pq.ParquetWriter(path, schema, compression=compression or "snappy")
+    options = pa.ipc.IpcWriteOptions(compression=compression) if compression else None
+    return pa.ipc.new_file(path, schema, options=options)
+
+
+def check_output_options(
+    output_format: str, compression: Optional[str], precision: Optional[int]
+) -> None:
+    """
+    Raise ValueError unless the output format, compression and CSV precision
+    can be written together (Feather takes zstd only; precision is 1-17 digits).
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unsupported output format: {output_format}")
+    if compression is not None and compression not in COMPRESSIONS:
+        raise ValueError(f"Unsupported compression: {compression}")
+    if output_format == "feather" and compression == "gzip":
+        raise ValueError("Feather output supports zstd compression only.")
+    if precision is not None and not 1 <= precision <= 17:
+        raise ValueError("precision must be between 1 and 17 significant digits.")
+
+
+class _ResultWriter:
+    """
+    Write result chunks to the prediction file as CSV, Parquet or Feather.
+
+    Chunks go to a ``.partial-*`` file in the same directory, which only
+    replaces ``path`` on ``commit``; ``close`` without a commit removes it,
+    so a run that fails partway never leaves a truncated prediction file.
+    ``header=False`` omits the CSV header, for row shards that are appended
+    after the first one. ``compression`` (gzip or zstd) compresses CSV
+    output as one stream, or sets the Parquet/Feather codec. ``precision``
+    limits CSV scores to that many significant digits.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        output_format: str,
+        model_names: List[str],
+        header: bool = True,
+        compression: Optional[str] = None,
+        precision: Optional[int] = None,
+    ):
+        check_output_options(output_format, compression, precision)
+        self.path = path
+        self.output_format = output_format
+        self.model_names = list(model_names)
+        self.header = header
+        self.compression = compression
+        self.float_format = f"%.{precision}g" if precision else None
+        self._handle: Optional[IO[str]] = None
+        self._writer = None
+        self._written = False
+        self._partial: Optional[str] = None
+
+    def _target(self) -> str:
+        if self._partial is None:
+            self._partial = _partial_path(self.path)
+        return self._partial
+
+    def write(self, results: pd.DataFrame) -> None:
+        if self.output_format == "csv":
+            if self._handle is None:
+                self._handle = _open_csv_output(self._target(), self.compression)
+            results.to_csv(
+                self._handle,
+                index=False,
+                header=self.header and not self._written,
+                float_format=self.float_format,
+            )
+            self._written = True
+            return
+
+        pa = _require_pyarrow()
+        # Keep every chunk's schema float32, including blocks patched from older files.
+        results = results.astype(
+            {
+                name: "float32"
+                for name in results.columns
+                if name in self.model_names or name.endswith(PERCENTILE_SUFFIX)
+            }
+        )
+        table = pa.Table.from_pandas(results, preserve_index=False)
+        if self._writer is None:
+            self._writer = _open_table_writer(
+                self._target(), self.output_format, table.schema, self.compression
+            )
+        self._writer.write_table(table)
+        self._written = True
+
+    def _flush(self) -> None:
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def commit(self) -> None:
+        """Move the finished file into place (nothing is created if no rows were written)."""
+        self._flush()
+        if self._partial is not None:
+            os.replace(self._partial, self.path)
+            self._partial = None
+
+    def close(self) -> None:
+        self._flush()
+        if self._partial is not None:
+            try:
+                os.unlink(self._partial)
+            except OSError:
+                pass
+            self._partial = None
+
+
+def _result_filename(
+    filepath: str, output_format: str, compression: Optional[str] = None
+) -> str:
+    """
+    ``predictions_<input name>``, plus the output extension unless the input has it.
+
+    The input's own extension stays in the name, so ``x.csv``, ``x.xlsx``
+    and ``x.parquet`` scored into one directory never share a prediction
+    file (``predictions_x.csv``, ``predictions_x.xlsx.csv``, ...).
+    """
+    original_filename = os.path.basename(filepath)
+    extension = OUTPUT_FORMATS[output_format]
+    name = (
+        original_filename
+        if original_filename.lower().endswith(extension)
+        else original_filename + extension
+    )
+    suffix = COMPRESSIONS[compression] if compression and output_format == "csv" else ""
+    return f"predictions_{name}{suffix}"
+
+
+class _SummaryAccumulator:
+    """
+    Per-model running statistics, updated block by block as results are written.
+
+    Sums keep the summary means exact across chunks. Quantiles come from a
+    DDSketch-style set of log-spaced bins: bin ``k`` holds the scores in
+    (gamma^(k-1), gamma^k] with gamma = (1 + a) / (1 - a), so every reported
+    quantile is within a relative error ``a`` (``SUMMARY_RELATIVE_ACCURACY``)
+    of a score of that rank, however close to zero the scores are. Scores
+    below ``SUMMARY_MIN_SCORE`` share one bin. The ``SUMMARY_HISTOGRAM_BINS``
+    histogram over ``SUMMARY_RANGE`` (scores outside it land in the edge
+    bins) and the counts above each of ``SUMMARY_THRESHOLDS`` are exact.
+    Every part is a plain sum over a fixed layout, so the accumulators of
+    chunks and row shards merge without loss.
+
+    Models without a single score (e.g. every block failed) are left out.
+    """
+
+    def __init__(self, model_names: List[str]):
+        import math  # noqa: PLC0415
+
+        self.model_names = list(model_names)
+        self._sums: Dict[str, float] = {}
+        self._counts: Dict[str, int] = {}
+        self._bins: Dict[str, np.ndarray] = {}
+        self._histogram: Dict[str, np.ndarray] = {}
+        self._above: Dict[str, np.ndarray] = {}
+        self._min: Dict[str, float] = {}
+        self._max: Dict[str, float] = {}
+        accuracy = SUMMARY_RELATIVE_ACCURACY
+        self._gamma = (1 + accuracy) / (1 - accuracy)
+        self._log_gamma = math.log(self._gamma)
+        # Bin 0 collects scores <= SUMMARY_MIN_SCORE; bin i > 0 is log-bin k_min + i - 1.
+        self._k_min = math.ceil(math.log(SUMMARY_MIN_SCORE) / self._log_gamma)
+        k_max = math.ceil(math.log(SUMMARY_RANGE[1]) / self._log_gamma)
+        self._size = k_max - self._k_min + 2
+
+    def _bin_counts(self, values: np.ndarray) -> np.ndarray:
+        import numpy as np  # noqa: PLC0415
+
+        positions = np.zeros(len(values), dtype=np.int64)
+        positive = values > SUMMARY_MIN_SCORE
+        logs = np.log(values[positive]) / self._log_gamma
+        positions[positive] = np.ceil(logs).astype(np.int64) - self._k_min + 1
+        return np.bincount(np.clip(positions, 0, self._size - 1), minlength=self._size)
+
+    def update(self, results: pd.DataFrame) -> None:
+        import numpy as np  # noqa: PLC0415
+        import pandas as pd  # noqa: PLC0415
+
+        low, high = SUMMARY_RANGE
+        thresholds = np.asarray(SUMMARY_THRESHOLDS, dtype=np.float64)
+        for name in self.model_names:
+            column = results[name]
+            if not pd.api.types.is_numeric_dtype(column):
+                continue
+            values = column.to_numpy(dtype=np.float64)
+            values = values[~np.isnan(values)]
+            if not len(values):
+                continue
+            self._sums[name] = self._sums.get(name, 0.0) + float(values.sum())
+            self._counts[name] = self._counts.get(name, 0) + len(values)
+            bins = self._bin_counts(values)
+            positions = ((values - low) * (SUMMARY_HISTOGRAM_BINS / (high - low))).astype(np.int64)
+            histogram = np.bincount(
+                np.clip(positions, 0, SUMMARY_HISTOGRAM_BINS - 1),
+                minlength=SUMMARY_HISTOGRAM_BINS,
+            )
+            above = (values[:, None] >= thresholds).sum(axis=0)
+            if name in self._bins:
+                self._bins[name] += bins
+                self._histogram[name] += histogram
+                self._above[name] += above
+                self._min[name] = min(self._min[name], float(values.min()))
+                self._max[name] = max(self._max[name], float(values.max()))
+            else:
+                self._bins[name], self._histogram[name] = bins, histogram
+                self._above[name] = above
+                self._min[name], self._max[name] = float(values.min()), float(values.max())
+
+    def merge(self, other: "_SummaryAccumulator") -> None:
+        """Fold in the statistics of another accumulator (e.g. from a row shard)."""
+        for name, total in other._sums.items():
+            self._sums[name] = self._sums.get(name, 0.0) + total
+            self._counts[name] = self._counts.get(name, 0) + other._counts[name]
+            if name in self._bins:
+                self._bins[name] = self._bins[name] + other._bins[name]
+                self._histogram[name] = self._histogram[name] + other._histogram[name]
+                self._above[name] = self._above[name] + other._above[name]
+                self._min[name] = min(self._min[name], other._min[name])
+                self._max[name] = max(self._max[name], other._max[name])
+            else:
+                self._bins[name], self._histogram[name] = other._bins[name], other._histogram[name]
+                self._above[name] = other._above[name]
+                self._min[name], self._max[name] = other._min[name], other._max[name]
+
+    def summary(self) -> Dict[str, float]:
+        return {
+            name: self._sums[name] / self._counts[name]
+            for name in self.model_names
+            if self._counts.get(name)
+        }
+
+    def _quantile(self, name: str, q: float) -> float:
+        import numpy as np  # noqa: PLC0415
+
+        cumulative = np.cumsum(self._bins[name])
+        rank = q * (cumulative[-1] - 1)
+        index = min(int(np.searchsorted(cumulative, rank, side="right")), self._size - 1)
+        if index == 0:
+            value = self._min[name]
+        else:
+            # The point of the bin within relative error of both of its edges.
+            value = 2 * self._gamma ** (self._k_min + index - 1) / (self._gamma + 1)
+        return min(max(value, self._min[name]), self._max[name])
+
+    def statistics(self) -> Dict[str, dict]:
+        """
+        Count, mean, min/max, quantiles, share above each threshold and a
+        ``SUMMARY_HISTOGRAM_BINS``-bin histogram for every model that has scores.
+        """
+        low, high = SUMMARY_RANGE
+        report = {}
+        for name in self.model_names:
+            count = self._counts.get(name)
+            if not count:
+                continue
+            report[name] = dict(
+                count=count,
+                mean=self._sums[name] / count,
+                min=self._min[name],
+                max=self._max[name],
+                quantiles={f"p{q * 100:g}": self._quantile(name, q) for q in SUMMARY_QUANTILES},
+                above={
+                    f"{threshold:g}": int(above) / count
+                    for threshold, above in zip(SUMMARY_THRESHOLDS, self._above[name])
+                },
+                histogram=dict(range=[low, high], counts=self._histogram[name].tolist()),
+            )
+        return report
+
+
+def top_k_contributions(contrib: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Pick each row's ``k`` strongest features from a ``pred_contrib`` matrix.
+
+    The last (bias) column is ignored. Candidates are found with one
+    ``argpartition`` over all rows and only the ``k`` survivors are sorted.
+    Returns (feature indices as int32, contributions as float32), each of
+    shape (rows, k), strongest first.
+    """
+    import numpy as np  # noqa: PLC0415
+
+    values = contrib[:, :-1]
+    k = min(k, values.shape[1])
+    magnitude = np.abs(values)
+    if k < values.shape[1]:
+        candidates = np.argpartition(-magnitude, k - 1, axis=1)[:, :k]
+    else:
+        candidates = np.broadcast_to(np.arange(k), (len(values), k))
+    order = np.argsort(-np.take_along_axis(magnitude, candidates, axis=1), axis=1, kind="stable")
+    index = np.take_along_axis(candidates, order, axis=1)
+    return index.astype(np.int32), np.take_along_axis(values, index, axis=1).astype(np.float32)
+
+
+def rank_features(candidates: Iterable[Tuple[str, float]], k: int) -> List[str]:
+    """Merge (feature, contribution) pairs from several models into the ``k`` strongest names."""
+    strongest: Dict[str, float] = {}
+    for feature, value in candidates:
+        if value == value and abs(value) > strongest.get(feature, -1.0):
+            strongest[feature] = abs(value)
+    return sorted(strongest, key=strongest.get, reverse=True)[:k]
+
+
+def top_proteins(archive, row: int, k: int = 10) -> List[str]:
+    """
+    The ``k`` features with the largest contribution to any model for one row.
+
+    ``archive`` is a ``contributions_*.npz`` file (or its ``np.load`` result);
+    this is the ``top_proteins`` list the advisory stage expects.
+    """
+    import numpy as np  # noqa: PLC0415
+
+    if isinstance(archive, (str, os.PathLike)):
+        with np.load(archive, allow_pickle=False) as loaded:
+            return top_proteins(loaded, row, k)
+    candidates = []
+    for name in archive["models"].tolist():
+        features = archive[f"{name}.features"]
+        index, value = archive[f"{name}.index"][row], archive[f"{name}.value"][row]
+        candidates.extend(
+            (str(features[position]), float(contribution))
+            for position, contribution in zip(index, value)
+            if position >= 0
+        )
+    return rank_features(candidates, k)
+
+
+class _ContributionWriter:
+    """
+    Write per-model top-k contributions chunk by chunk into one ``.npz``.
+
+    For every model the archive holds ``<model>.features`` (its feature
+    names), ``<model>.index`` (rows x k positions into those names, -1 when
+    the model failed) and ``<model>.value`` (float32 contributions), next to
+    ``ids`` / ``id_column`` and the ``models`` list. Each chunk is appended
+    to spool files beside ``path`` as it arrives; ``save`` streams them into
+    the archive, so memory stays bounded by the chunk size.
+    """
+
+    def __init__(self, path: str, models: List[LoadedModel], top_k: int):
+        self.path = path
+        self.top_k = top_k
+        self.features = {model.name: list(model.feature_names) for model in models}
+        self._id_column = "row_id"
+        self._id_dtypes: List[np.dtype] = []
+        self._rows = 0
+        self._spool = tempfile.TemporaryDirectory(
+            prefix=".contributions-", dir=os.path.dirname(os.path.abspath(path))
+        )
+        self._ids = open(os.path.join(self._spool.name, "ids"), "wb")
+        self._arrays: Dict[str, IO[bytes]] = {}
+        for position, name in enumerate(self.features):
+            for part in ("index", "value"):
+                spool = os.path.join(self._spool.name, f"{position}.{part}")
+                self._arrays[f"{name}.{part}"] = open(spool, "wb")
+
+    def _width(self, name: str) -> int:
+        return min(self.top_k, len(self.features[name]))
+
+    def add(self, results: pd.DataFrame, contributions: Dict[str, Tuple[np.ndarray, np.ndarray]]):
+        import numpy as np  # noqa: PLC0415
+
+        self._id_column = results.columns[0]
+        ids = results[self._id_column].to_numpy()
+        if ids.dtype == object:
+            ids = ids.astype(str)
+        # Chunks may infer different id dtypes; each is spooled with its own header.
+        np.save(self._ids, ids, allow_pickle=False)
+        self._id_dtypes.append(ids.dtype)
+        rows = len(results)
+        for name in self.features:
+            index, value = contributions.get(name) or (
+                np.full((rows, self._width(name)), -1, dtype=np.int32),
+                np.full((rows, self._width(name)), np.nan, dtype=np.float32),
+            )
+            self._arrays[f"{name}.index"].write(np.ascontiguousarray(index, np.int32).data)
+            self._arrays[f"{name}.value"].write(np.ascontiguousarray(value, np.float32).data)
+        self._rows += rows
+
+    def _ids_dtype(self) -> np.dtype:
+        import numpy as np  # noqa: PLC0415
+
+        if not self._id_dtypes:
+            return np.dtype(np.float64)
+        if any(dtype.kind == "U" for dtype in self._id_dtypes):
+            # Numeric chunks next to text ids are written as text as well.
+            widths = [dtype.itemsize // 4 if dtype.kind == "U" else 32 for dtype in self._id_dtypes]
+            return np.dtype(f"<U{max(widths)}")
+        return np.result_type(*self._id_dtypes)
+
+    def save(self) -> str:
+        """Stream the spooled chunks into ``path`` and return it."""
+        import zipfile  # noqa: PLC0415
+
+        import numpy as np  # noqa: PLC0415
+
+        for handle in (self._ids, *self._arrays.values()):
+            handle.close()
+        partial = _partial_path(self.path)
+        try:
+            with zipfile.ZipFile(partial, "w", allowZip64=True) as archive:
+
+                def member(key: str, dtype, shape: Tuple[int, ...]) -> IO[bytes]:
+                    handle = archive.open(f"{key}.npy", "w", force_zip64=True)
+                    header = dict(
+                        descr=np.lib.format.dtype_to_descr(np.dtype(dtype)),
+                        fortran_order=False,
+                        shape=shape,
+                    )
+                    np.lib.format.write_array_header_2_0(handle, header)
+                    return handle
+
+                ids_dtype = self._ids_dtype()
+                with member("ids", ids_dtype, (self._rows,)) as target, open(
+                    self._ids.name, "rb"
+                ) as source:
+                    for _ in self._id_dtypes:
+                        chunk = np.load(source, allow_pickle=False)
+                        target.write(np.ascontiguousarray(chunk, ids_dtype).data)
+                for key, value in (
+                    ("id_column", np.asarray(self._id_column)),
+                    ("models", np.asarray(list(self.features))),
+                ):
+                    with archive.open(f"{key}.npy", "w", force_zip64=True) as target:
+                        np.lib.format.write_array(target, value, allow_pickle=False)
+                for name, features in self.features.items():
+                    with archive.open(f"{name}.features.npy", "w", force_zip64=True) as target:
+                        np.lib.format.write_array(target, np.asarray(features), allow_pickle=False)
+                    shape = (self._rows, self._width(name))
+                    for part, dtype in (("index", np.int32), ("value", np.float32)):
+                        spool = self._arrays[f"{name}.{part}"].name
+                        with member(f"{name}.{part}", dtype, shape) as target, open(
+                            spool, "rb"
+                        ) as source:
+                            shutil.copyfileobj(source, target, 1 << 20)
+            os.replace(partial, self.path)
+        except BaseException:
+            if os.path.exists(partial):
+                os.unlink(partial)
+            raise
+        finally:
+            self.close()
+        return self.path
+
+    def close(self) -> None:
+        """Drop the spool files (``save`` calls this itself)."""
+        for handle in (self._ids, *self._arrays.values()):
+            handle.close()
+        self._spool.cleanup()
+
+
+def manifest_path(result_filepath: str) -> str:
+    """Path of the manifest sidecar recorded for a prediction file."""
+    directory, name = os.path.split(result_filepath)
+    return os.path.join(directory, f".{name}{MANIFEST_SUFFIX}")
+
+
+def read_manifest(result_filepath: str) -> dict:
+    """Load a prediction file's manifest; FileNotFoundError if it has none."""
+    path = manifest_path(result_filepath)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"No manifest recorded for {result_filepath}")
+    with open(path, "r", encoding="utf-8") as handle:
+        return json.load(handle)
+
+
+def _partial_path(path: str) -> str:
+    """Hidden sibling of ``path`` to write to before it is moved into place."""
+    directory, name = os.path.split(os.path.abspath(path))
+    return os.path.join(
+        directory, f".partial-{os.getpid()}-{threading.get_ident()}-{time.monotonic_ns()}-{name}"
+    )
+
+
+def _copy_into_place(source: str, target: str) -> None:
+    """Copy ``source`` to ``target`` through a temporary file, so ``target`` is never partial."""
+    partial = _partial_path(target)
+    try:
+        shutil.copyfile(source, partial)
+        os.replace(partial, target)
+    finally:
+        if os.path.exists(partial):
+            os.unlink(partial)
+
+
+def _write_manifest(result_filepath: str, manifest: dict) -> None:
+    path = manifest_path(result_filepath)
+    partial = f"{path}.{os.getpid()}.tmp"
+    with open(partial, "w", encoding="utf-8") as handle:
+        json.dump(manifest, handle, indent=2, default=str)
+    os.replace(partial, path)
+
+
+def iter_prediction_frames(
+    path: str,
+    output_format: str,
+    chunksize: Optional[int] = None,
+    columns: Optional[List[str]] = None,
+) -> Iterator[pd.DataFrame]:
+    """
+    Yield a prediction file written as ``output_format``, whole or in row chunks.
+
+    The reader follows the run's format rather than the file name, and
+    compressed CSV is decoded by pandas. Only ``columns`` that exist are read.
+    """
+    import pandas as pd  # noqa: PLC0415
+
+    if output_format != "csv":
+        return _iter_arrow_frames(path, chunksize, columns)
+    wanted = set(columns) if columns else None
+    # round_trip parsing keeps untouched score columns bit-identical on rewrite.
+    options = dict(
+        usecols=(lambda name: name in wanted) if wanted is not None else None,
+        float_precision="round_trip",
+    )
+    if chunksize:
+        return iter(pd.read_csv(path, chunksize=chunksize, **options))
+    return iter([pd.read_csv(path, **options)])
+
+
+class _ResultPatcher:
+    """
+    Rewrite an existing prediction file with some model columns replaced.
+
+    It takes the place of a ``_ResultWriter``: every results block written
+    to it is matched with the same rows of the old file, whose other columns
+    are kept as they are. The new file replaces the old one on ``commit``.
+    """
+
+    def __init__(
+        self,
+        result_filepath: str,
+        output_format: str,
+        model_names: List[str],
+        patched: List[str],
+        chunksize: Optional[int],
+        compression: Optional[str] = None,
+        precision: Optional[int] = None,
+    ):
+        self.path = result_filepath
+        self.patched = list(patched)
+        self._old = iter_prediction_frames(result_filepath, output_format, chunksize)
+        self._buffer: List[pd.DataFrame] = []
+        self._writer = _ResultWriter(
+            result_filepath,
+            output_format,
+            model_names,
+            compression=compression,
+            precision=precision,
+        )
+        self.accumulator = _SummaryAccumulator(model_names)
+
+    def _take(self, count: int) -> pd.DataFrame:
+        import pandas as pd  # noqa: PLC0415
+
+        available = sum(len(frame) for frame in self._buffer)
+        while available < count:
+            frame = next(self._old, None)
+            if frame is None:
+                raise ValueError(f"{self.path} has fewer rows than its input file")
+            self._buffer.append(frame)
+            available += len(frame)
+        merged = self._buffer[0] if len(self._buffer) == 1 else pd.concat(self._buffer)
+        merged = merged.reset_index(drop=True)
+        self._buffer = [merged.iloc[count:]] if available > count else []
+        return merged.iloc[:count].copy()
+
+    def write(self, results: pd.DataFrame) -> None:
+        old = self._take(len(results))
+        for key in ("eid", "row_id"):
+            if key in old.columns and key in results.columns:
+                if (old[key].astype(str).to_numpy() != results[key].astype(str).to_numpy()).any():
+                    raise ValueError(f"Rows of {self.path} no longer match its input file")
+                break
+        for name in self.patched:
+            old[name] = results[name].to_numpy()
+            percentile = name + PERCENTILE_SUFFIX
+            if percentile in results.columns:
+                old[percentile] = results[percentile].to_numpy()
+            elif percentile in old.columns:
+                # The retrained model has no reference distribution yet.
+                old = old.drop(columns=percentile)
+        self._writer.write(old)
+        self.accumulator.update(old)
+
+    def commit(self) -> None:
+        if self._buffer or next(self._old, None) is not None:
+            raise ValueError(f"{self.path} has more rows than its input file")
+        self._writer.commit()
+
+    def close(self) -> None:
+        self._writer.close()
+
+
+def _contributions_filename(filepath: str) -> str:
+    """``contributions_<input name>.npz``, keeping the extension like the prediction file."""
+    return f"contributions_{os.path.basename(filepath)}.npz"
+
+
+def _read_plan(layout: FeatureLayout, schema: PreprocessingSchema) -> Tuple[List[str], List[str]]:
+    """Columns to read from an input file, and those that can be parsed as float32."""
+    columns = list(dict.fromkeys([*ID_COLUMNS, *layout.features]))
+    float_columns = [
+        name
+        for name in layout.features
+        if name not in ID_COLUMNS and not schema.spec_for(name).categories
+    ]
+    return columns, float_columns
+
+
+def _warn_missing_features(models: List[LoadedModel], columns) -> None:
+    present = set(columns)
+    for model in models:
+        missing = set(model.feature_names) - present
+        if missing:
+            logging.warning(
+                "Model %s is missing %d features. Filling with zeros.",
+                model.name,
+                len(missing),
+            )
+
+
+class ScoringEngine:
+    """
+    Resident models, preprocessing schema, CPU scheduler and prediction cache
+    for one model directory.
+    """
+
+    def __init__(self, settings: EngineSettings):
+        self.settings = settings
+        self.registry = ModelRegistry(settings.model_dir)
+        self.scheduler = InferenceScheduler(settings.cpu_budget)
+        self.cache: Optional[PredictionCache] = None
+        if settings.cache_dir and settings.cache_max_bytes > 0:
+            self.cache = PredictionCache(settings.cache_dir, settings.cache_max_bytes)
+        self._schema_key: Optional[Tuple[str, float]] = None
+        self._schema: Optional[PreprocessingSchema] = None
+        self._reference_key: Optional[float] = None
+        self._reference: Optional[ReferenceIndex] = None
+        self._shard_pool: Optional[ProcessPoolExecutor] = None
+        self._shard_pool_workers = 0
+        self._lock = threading.Lock()
+
+    def refresh(self) -> ModelRegistry:
+        """Pick up added, changed or removed model files and return the registry."""
+        self.registry.refresh()
+        return self.registry
+
+    def schema(self) -> PreprocessingSchema:
+        """
+        Return the deployment's preprocessing schema, reloaded when its file changes.
+
+        ``schema_path`` defaults to ``<model_dir>/preprocessing.json``; without
+        a schema file the legacy encoding (``sex`` only) is used.
+        """
+        from preprocessing import PreprocessingSchema  # noqa: PLC0415
+
+        path = self.settings.schema_path or os.path.join(
+            self.settings.model_dir, "preprocessing.json"
+        )
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            if self.settings.schema_path:
+                raise FileNotFoundError(f"Preprocessing schema not found: {path}") from None
+            path, mtime = "", 0.0
+
+        with self._lock:
+            if self._schema is None or self._schema_key != (path, mtime):
+                schema = PreprocessingSchema.from_file(path) if path else PreprocessingSchema()
+                if path:
+                    logging.info("Loaded preprocessing schema %s (%s)", path, schema.fingerprint)
+                self._schema, self._schema_key = schema, (path, mtime)
+            return self._schema
+
+    def reference(self) -> Optional[ReferenceIndex]:
+        """Reference quantiles from ``<model_dir>/reference_quantiles.npz``, reloaded on change."""
+        path = os.path.join(self.settings.model_dir, REFERENCE_FILENAME)
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return None
+        with self._lock:
+            if self._reference_key != mtime:
+                from reference_index import ReferenceIndex  # noqa: PLC0415
+
+                try:
+                    self._reference = ReferenceIndex.load(path)
+                    logging.info(
+                        "Loaded reference quantiles for %d models (%s)",
+                        len(self._reference.quantiles),
+                        self._reference.fingerprint,
+                    )
+                except (OSError, ValueError, KeyError):
+                    logging.exception("Ignoring unreadable reference file %s", path)
+                    self._reference = None
+                self._reference_key = mtime
+            return self._reference
+
+    def percentiles(
+        self, models: List[LoadedModel], predictions: Dict[str, Optional[np.ndarray]]
+    ) -> Dict[str, Optional[np.ndarray]]:
+        """
+        Reference-population percentiles for the models that have a current reference.
+
+        A model with a reference but no predictions (it failed) maps to None.
+        """
+        reference = self.reference()
+        if reference is None:
+            return {}
+        found = {}
+        for model in models:
+            if reference.model_hashes.get(model.name) != model.sha256:
+                continue
+            values = predictions.get(model.name)
+            found[model.name] = (
+                None if values is None else reference.percentiles(model.name, model.sha256, values)
+            )
+        return found
+
+    def warm_up(self) -> ModelRegistry:
+        """Load models, schema, reference quantiles and the feature layout."""
+        registry = self.refresh()
+        self.schema()
+        self.reference()
+        registry.layout()
+        return registry
+
+    def select(
+        self, selection: Optional[ModelSelection] = None
+    ) -> Tuple[List[LoadedModel], FeatureLayout]:
+        """
+        Return the models a request runs and the feature layout over just those models.
+
+        Raises FileNotFoundError without models and ValueError for a bad selection.
+        """
+        registry = self.refresh()
+        models = registry.models()
+        if not models:
+            raise FileNotFoundError(
+                f"No LightGBM models were found in {self.settings.model_dir}."
+            )
+        if selection:
+            models = selection.apply(models, registry.tags())
+        return models, registry.layout(models)
+
+    def iter_input_frames(
+        self, filepath: str, layout: FeatureLayout, chunksize: Optional[int] = None
+    ) -> Iterator[pd.DataFrame]:
+        """
+        Yield an input table whole or in ``chunksize``-row chunks, reading only
+        ``eid``, ``sex`` and the features of ``layout`` (numeric ones as float32).
+        """
+        columns, float_columns = _read_plan(layout, self.schema())
+        return _iter_input_frames(
+            filepath, chunksize, columns=columns, float_columns=float_columns
+        )
+
+    def encode(self, new_data: pd.DataFrame, layout: FeatureLayout) -> np.ndarray:
+        """Run the preprocessing schema once and return the feature-union matrix."""
+        return self.schema().transform(new_data, layout.features)
+
+    def predict_matrix(
+        self,
+        matrix: np.ndarray,
+        models: List[LoadedModel],
+        layout: FeatureLayout,
+        progress: Optional[Callable[[str, str], None]] = None,
+        top_k: int = 0,
+        contributions: Optional[Dict[str, Tuple[np.ndarray, np.ndarray]]] = None,
+    ) -> Dict[str, Optional[np.ndarray]]:
+        """
+        Run every model on its columns of ``matrix``; failed models map to None.
+
+        With ``top_k`` and a ``contributions`` dict, each model also runs
+        ``pred_contrib`` on the same slice in the same scheduled task, and
+        ``contributions[model]`` receives its ``top_k_contributions``.
+        """
+        def report(model_name: str, status: str) -> None:
+            if progress is not None:
+                progress(model_name, status)
+
+        def run_model(model: LoadedModel, num_threads: int):
+            logging.info("Running model: %s (num_threads=%d)", model.name, num_threads)
+            report(model.name, "running")
+            try:
+                if model.booster is None:
+                    raise RuntimeError(f"Model could not be loaded: {model.error}")
+                X_predict = matrix[:, layout.model_columns[model.name]]
+                predictions = model.booster.predict(X_predict, num_threads=num_threads)
+                if top_k and contributions is not None:
+                    contrib = model.booster.predict(
+                        X_predict, pred_contrib=True, num_threads=num_threads
+                    )
+                    contributions[model.name] = top_k_contributions(contrib, top_k)
+                report(model.name, "done")
+                return predictions
+            except Exception as err:  # noqa: BLE001
+                logging.exception("Model %s failed: %s", model.name, err)
+                report(model.name, "failed")
+                return None
+
+        return self.scheduler.run(models, run_model)
+
+    def score_frame(
+        self,
+        new_data: pd.DataFrame,
+        models: List[LoadedModel],
+        layout: FeatureLayout,
+        first_row: int = 0,
+        warn_missing: bool = True,
+        progress: Optional[Callable[[str, str], None]] = None,
+        contributions: Optional[_ContributionWriter] = None,
+    ) -> pd.DataFrame:
+        """Score one table (or chunk) against every model and return its results frame."""
+        results = _prepare_results_frame(new_data, first_row)
+        if warn_missing:
+            _warn_missing_features(models, new_data.columns)
+
+        matrix = self.encode(new_data, layout)
+        return self._finish_block(results, matrix, models, layout, progress, contributions)
+
+    def _finish_block(
+        self,
+        results: pd.DataFrame,
+        matrix: np.ndarray,
+        models: List[LoadedModel],
+        layout: FeatureLayout,
+        progress: Optional[Callable[[str, str], None]],
+        contributions: Optional[_ContributionWriter],
+    ) -> pd.DataFrame:
+        import numpy as np  # noqa: PLC0415
+        import pandas as pd  # noqa: PLC0415
+
+        found: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+        predictions = self.predict_matrix(
+            matrix,
+            models,
+            layout,
+            progress=progress,
+            top_k=contributions.top_k if contributions is not None else 0,
+            contributions=found,
+        )
+        # Scores (and percentiles) go into one preallocated float32 block each;
+        # a failed model keeps its NaN column instead of an object column.
+        blocks = [results]
+        for columns in (predictions, self.percentiles(models, predictions)):
+            if not columns:
+                continue
+            block = np.full((len(results), len(columns)), np.nan, dtype=np.float32)
+            for position, values in enumerate(columns.values()):
+                if values is not None:
+                    block[:, position] = values
+            names = list(columns)
+            if columns is not predictions:
+                names = [name + PERCENTILE_SUFFIX for name in names]
+            blocks.append(pd.DataFrame(block, columns=names, index=results.index, copy=False))
+        results = pd.concat(blocks, axis=1)
+        if contributions is not None:
+            contributions.add(results, found)
+        return results
+
+    def score_frames(
+        self,
+        frames: List[pd.DataFrame],
+        selection: Optional[ModelSelection] = None,
+        top_k: int = 0,
+    ) -> Tuple[List[str], List[Dict[str, Optional[np.ndarray]]], List[Dict[str, list]]]:
+        """
+        Score several in-memory tables with one predict call per model.
+
+        Each table is encoded on its own (so absent-feature handling is per
+        table), the matrices are stacked, and the predictions are split back.
+        Returns (model names, predictions per table, contributions per table);
+        with ``top_k`` the latter maps each model to one list of
+        (feature, contribution) pairs per row, otherwise it is empty.
+        """
+        import numpy as np  # noqa: PLC0415
+
+        models, layout = self.select(selection)
+        matrices = [self.encode(frame, layout) for frame in frames]
+        matrix = matrices[0] if len(matrices) == 1 else np.vstack(matrices)
+        found: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+        predictions = self.predict_matrix(
+            matrix, models, layout, top_k=top_k, contributions=found
+        )
+
+        per_frame = []
+        per_frame_contributions = []
+        offset = 0
+        for frame in frames:
+            stop = offset + len(frame)
+            per_frame.append(
+                {
+                    name: None if values is None else values[offset:stop]
+                    for name, values in predictions.items()
+                }
+            )
+            frame_contributions = {}
+            for model in models:
+                if model.name not in found:
+                    continue
+                index, value = found[model.name]
+                frame_contributions[model.name] = [
+                    [
+                        (model.feature_names[position], float(contribution))
+                        for position, contribution in zip(row_index, row_value)
+                    ]
+                    for row_index, row_value in zip(index[offset:stop], value[offset:stop])
+                ]
+            per_frame_contributions.append(frame_contributions)
+            offset = stop
+        return [model.name for model in models], per_frame, per_frame_contributions
+
+    def _score_stream(
+        self,
+        frames: Iterable[pd.DataFrame],
+        writer: _ResultWriter,
+        models: List[LoadedModel],
+        layout: FeatureLayout,
+        first_row: int = 0,
+        progress: Optional[Callable[[str, str], None]] = None,
+        contributions: Optional[_ContributionWriter] = None,
+    ) -> Tuple[int, List[str], _SummaryAccumulator]:
+        """Score and write ``frames``; return (rows, missing features, summary accumulator)."""
+        accumulator = _SummaryAccumulator([model.name for model in models])
+        missing_features: List[str] = []
+        rows = 0
+        for new_data in frames:
+            if rows == 0:
+                present = set(new_data.columns)
+                missing_features = [name for name in layout.features if name not in present]
+                logging.info(
+                    "Read %d of %d model features",
+                    len(layout.features) - len(missing_features),
+                    len(layout.features),
+                )
+            start = first_row + rows
+            logging.info("Scoring rows %d-%d", start + 1, start + len(new_data))
+            results = self.score_frame(
+                new_data,
+                models,
+                layout,
+                first_row=start,
+                warn_missing=start == 0,
+                progress=progress,
+                contributions=contributions,
+            )
+            writer.write(results)
+            accumulator.update(results)
+            rows += len(new_data)
+        return rows, missing_features, accumulator
+
+    def _score_npy(
+        self,
+        filepath: str,
+        writer: _ResultWriter,
+        models: List[LoadedModel],
+        layout: FeatureLayout,
+        chunksize: Optional[int],
+        progress: Optional[Callable[[str, str], None]] = None,
+        contributions: Optional[_ContributionWriter] = None,
+    ) -> Tuple[int, List[str], _SummaryAccumulator]:
+        """
+        Score a memory-mapped ``.npy`` matrix block by block.
+
+        Each block of rows is encoded straight from the mapped pages, so only
+        one block of features is ever resident, and pandas is used only for
+        the results frame.
+        """
+        import numpy as np  # noqa: PLC0415
+        import pandas as pd  # noqa: PLC0415
+
+        matrix, columns, ids = _open_npy(filepath)
+        present = set(columns)
+        missing_features = [name for name in layout.features if name not in present]
+        _warn_missing_features(models, columns)
+        logging.info(
+            "Mapped %s: %d rows, %d of %d model features",
+            filepath,
+            matrix.shape[0],
+            len(layout.features) - len(missing_features),
+            len(layout.features),
+        )
+
+        schema = self.schema()
+        accumulator = _SummaryAccumulator([model.name for model in models])
+        block_rows = chunksize or NPY_BLOCK_ROWS
+        for start in range(0, matrix.shape[0], block_rows):
+            stop = min(start + block_rows, matrix.shape[0])
+            logging.info("Scoring rows %d-%d", start + 1, stop)
+            encoded = schema.transform_array(matrix[start:stop], columns, layout.features)
+            if ids is not None:
+                results = pd.DataFrame({"eid": ids[start:stop]})
+            else:
+                results = pd.DataFrame({"row_id": np.arange(start + 1, stop + 1)})
+            results = self._finish_block(
+                results, encoded, models, layout, progress, contributions
+            )
+            writer.write(results)
+            accumulator.update(results)
+        return matrix.shape[0], missing_features, accumulator
+
+    def _score_sharded(
+        self,
+        filepath: str,
+        result_filepath: str,
+        output_format: str,
+        model_names: List[str],
+        layout: FeatureLayout,
+        chunksize: Optional[int],
+        workers: int,
+        progress: Optional[Callable[[str, str], None]] = None,
+        compression: Optional[str] = None,
+        precision: Optional[int] = None,
+    ) -> Optional[Tuple[int, List[str], _SummaryAccumulator]]:
+        """
+        Score ``filepath`` as row shards on a process pool, or return None if it cannot be split.
+
+        Each worker of the engine's shard pool parses, preprocesses and scores
+        its own shard with ``cpu_budget // workers`` cores. Shard outputs are
+        concatenated in row order into ``result_filepath``.
+        """
+        ranges = _shard_ranges(filepath, workers)
+        if len(ranges) < 2:
+            logging.info("%s cannot be split into row shards; scoring serially", filepath)
+            return None
+
+        part_dir = tempfile.mkdtemp(prefix=".shards-", dir=os.path.dirname(result_filepath))
+        suffix = OUTPUT_FORMATS[output_format]
+        shards = [
+            _Shard(
+                index=index,
+                filepath=filepath,
+                start=start,
+                stop=stop,
+                first_row=first_row,
+                part_path=os.path.join(part_dir, f"part-{index:05d}{suffix}"),
+                model_version=layout.version,
+                model_names=tuple(model_names),
+                compression=compression,
+                precision=precision,
+            )
+            for index, (start, stop, first_row) in enumerate(ranges)
+        ]
+        logging.info("Scoring %s as %d row shards", filepath, len(shards))
+        if progress is not None:
+            for name in model_names:
+                progress(name, "running")
+        pool = self._shard_pool_for(workers)
+        try:
+            outcomes = list(
+                pool.map(
+                    _score_shard,
+                    shards,
+                    [chunksize] * len(shards),
+                    [output_format] * len(shards),
+                )
+            )
+            _merge_parts(
+                [shard.part_path for shard in shards], result_filepath, output_format, compression
+            )
+        except BrokenProcessPool:
+            self._discard_shard_pool(pool)
+            raise
+        finally:
+            shutil.rmtree(part_dir, ignore_errors=True)
+
+        accumulator = _SummaryAccumulator(model_names)
+        for _, _, shard_accumulator in outcomes:
+            accumulator.merge(shard_accumulator)
+        if progress is not None:
+            for name in model_names:
+                progress(name, "done")
+        return sum(rows for rows, _, _ in outcomes), outcomes[0][1], accumulator
+
+    def _shard_pool_for(self, workers: int) -> ProcessPoolExecutor:
+        """
+        Return the engine's process pool for ``workers`` row shards.
+
+        The pool outlives a run, so its workers load the models once rather
+        than per file (later runs only re-parse changed model files). Workers
+        are started by a fork server (spawn where unavailable): a plain fork
+        of a process whose OpenMP runtime has started threads can hang.
+        """
+        with self._lock:
+            if self._shard_pool is not None and self._shard_pool_workers == workers:
+                return self._shard_pool
+            if self._shard_pool is not None:
+                # Shards already submitted by other runs still finish.
+                self._shard_pool.shutdown(wait=False)
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context(
+                "forkserver" if "forkserver" in methods else "spawn"
+            )
+            settings = dataclasses.replace(
+                self.settings,
+                cpu_budget=max(1, self.settings.cpu_budget // workers),
+                cache_max_bytes=0,
+            )
+            self._shard_pool = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=context,
+                initializer=_init_shard_worker,
+                initargs=(settings,),
+            )
+            self._shard_pool_workers = workers
+            return self._shard_pool
+
+    def _discard_shard_pool(self, pool: ProcessPoolExecutor) -> None:
+        with self._lock:
+            if self._shard_pool is pool:
+                self._shard_pool = None
+                self._shard_pool_workers = 0
+        pool.shutdown(wait=False)
+
+    def close(self) -> None:
+        """Stop the shard worker processes, if any were started."""
+        with self._lock:
+            pool, self._shard_pool, self._shard_pool_workers = self._shard_pool, None, 0
+        if pool is not None:
+            pool.shutdown()
+
+    def predict_file(
+        self,
+        filepath: str,
+        user_dir: str,
+        chunksize: Optional[int] = None,
+        progress: Optional[Callable[[str, str], None]] = None,
+        output_format: str = "csv",
+        run_info: Optional[dict] = None,
+        workers: Optional[int] = None,
+        selection: Optional[ModelSelection] = None,
+        contributions: int = 0,
+        compression: Optional[str] = None,
+        precision: Optional[int] = None,
+    ):
+        """
+        Run the resident models (or a ``selection``) on the file; return (prediction_file, summary).
+
+        The file is read ``chunksize`` rows at a time when given, split into
+        ``workers`` row shards when that is above 1, and memory-mapped for a
+        ``.npy`` matrix. ``output_format``, ``compression`` and ``precision``
+        shape the prediction file (see ``check_output_options``);
+        ``contributions`` = k also saves each row's k strongest features.
+        ``progress(model_name, status)`` reports each model and ``run_info``
+        receives the run's details (rows, models_run, statistics, cache, ...).
+        Results are cached by input and model-file hashes, and a manifest
+        sidecar lets ``rescore_file`` refresh retrained models later.
+        """
+        check_output_options(output_format, compression, precision)
+        schema = self.schema()
+        result_filepath = os.path.join(
+            user_dir, _result_filename(filepath, output_format, compression)
+        )
+
+        reference = self.reference()
+        manifest = dict(
+            input=os.path.abspath(filepath),
+            input_digest=None,
+            input_stat=_input_stat(filepath),
+            output_format=output_format,
+            compression=compression,
+            precision=precision,
+            schema=schema.fingerprint,
+            created_at=time.time(),
+        )
+        cache = self.cache if not contributions else None
+        cache_key = model_set_version = None
+        if cache is not None:
+            # Keyed on model file hashes, so a hit never parses a booster.
+            digests = self.registry.digests()
+            if not digests:
+                raise FileNotFoundError(
+                    f"No LightGBM models were found in {self.settings.model_dir}."
+                )
+            model_names = sorted(digests)
+            if selection:
+                model_names = selection.names(model_names, self.registry.tags())
+            model_set_version = _model_set_version(digests)
+            manifest["input_digest"] = _input_digest(filepath)
+            cache_key = cache.make_key(
+                manifest["input_digest"],
+                model_set_version,
+                schema=schema.fingerprint,
+                output_format=output_format,
+                compression=compression,
+                precision=precision,
+                models=model_names,
+                reference=reference.fingerprint if reference is not None else None,
+            )
+            entry = cache.get(cache_key)
+            if entry is not None:
+                _copy_into_place(entry.result_path, result_filepath)
+                logging.info("Prediction cache hit for %s; stored at %s", filepath, result_filepath)
+                if progress is not None:
+                    for name in model_names:
+                        progress(name, "done")
+                if run_info is not None:
+                    run_info.update(entry.run_info, cache="hit")
+                _write_manifest(
+                    result_filepath,
+                    dict(
+                        manifest,
+                        models={name: digests[name] for name in model_names},
+                        rows=entry.run_info.get("rows"),
+                        summary=entry.summary,
+                        statistics=entry.run_info.get("statistics"),
+                    ),
+                )
+                return result_filepath, entry.summary
+
+        models, layout = self.select(selection)
+        logging.info("Using %d resident models", len(models))
+        model_names = [model.name for model in models]
+        if layout.version != model_set_version:
+            # A model file changed after the cache lookup; do not file this run under its key.
+            cache_key = None
+        manifest["models"] = {model.name: model.sha256 for model in models}
+
+        collector = None
+        if contributions:
+            collector = _ContributionWriter(
+                os.path.join(user_dir, _contributions_filename(filepath)), models, contributions
+            )
+        try:
+            outcome = None
+            if filepath.lower().endswith(NPY_EXTENSIONS):
+                writer = _ResultWriter(
+                    result_filepath,
+                    output_format,
+                    model_names,
+                    compression=compression,
+                    precision=precision,
+                )
+                try:
+                    outcome = self._score_npy(
+                        filepath, writer, models, layout, chunksize, progress, collector
+                    )
+                    writer.commit()
+                finally:
+                    writer.close()
+            elif workers and workers > 1 and collector is None:
+                outcome = self._score_sharded(
+                    filepath,
+                    result_filepath,
+                    output_format,
+                    model_names,
+                    layout,
+                    chunksize,
+                    workers,
+                    progress=progress,
+                    compression=compression,
+                    precision=precision,
+                )
+            if outcome is None:
+                logging.info("Reading uploaded file: %s", filepath)
+                writer = _ResultWriter(
+                    result_filepath,
+                    output_format,
+                    model_names,
+                    compression=compression,
+                    precision=precision,
+                )
+                try:
+                    outcome = self._score_stream(
+                        self.iter_input_frames(filepath, layout, chunksize),
+                        writer,
+                        models,
+                        layout,
+                        progress=progress,
+                        contributions=collector,
+                    )
+                    writer.commit()
+                finally:
+                    writer.close()
+        except BaseException:
+            if collector is not None:
+                collector.close()
+            raise
+        rows, missing_features, accumulator = outcome
+        logging.info("Scored %d rows. Prediction file stored at %s", rows, result_filepath)
+
+        summary = accumulator.summary()
+        details = dict(
+            rows=rows,
+            model_version=layout.version,
+            models_run=model_names,
+            missing_features=missing_features,
+            statistics=accumulator.statistics(),
+        )
+        if cache_key is not None:
+            try:
+                cache.put(cache_key, result_filepath, summary, details)
+            except OSError:
+                logging.exception("Could not store %s in the prediction cache", result_filepath)
+        if collector is not None:
+            details["contributions_file"] = collector.save()
+        _write_manifest(
+            result_filepath,
+            dict(
+                manifest,
+                rows=rows,
+                summary=summary,
+                statistics=details["statistics"],
+                contributions_file=details.get("contributions_file"),
+            ),
+        )
+        if run_info is not None:
+            run_info.update(details, cache="off" if cache is None else "miss")
+        return result_filepath, summary
+
+    def rescore_file(
+        self,
+        result_filepath: str,
+        chunksize: Optional[int] = None,
+        progress: Optional[Callable[[str, str], None]] = None,
+        run_info: Optional[dict] = None,
+    ):
+        """
+        Bring an earlier prediction file up to date with the current model files.
+
+        Only models whose file hash differs from the manifest are run (every
+        model if the preprocessing schema changed), reading just their
+        features from the original input. Their score and percentile columns
+        are patched into the prediction file; all other columns are copied
+        unchanged. Returns (prediction_file, summary) like ``predict_file``;
+        ``run_info["models_rescored"]`` lists the models that were run.
+        The prediction store is not touched here; callers record the
+        re-scored columns (see ``predict_cli.rescore_prediction``).
+
+        Raises FileNotFoundError without a manifest or input file, and
+        ValueError if the input changed since the prediction was made.
+        """
+        manifest = read_manifest(result_filepath)
+        filepath = manifest["input"]
+        if not os.path.exists(filepath):
+            raise FileNotFoundError(f"Input file {filepath} of {result_filepath} is gone.")
+        if manifest.get("input_digest"):
+            input_changed = _input_digest(filepath) != manifest["input_digest"]
+        else:
+            # Only cached runs hash the input; otherwise its size and mtime decide.
+            input_changed = _input_stat(filepath) != manifest.get("input_stat")
+        if input_changed:
+            raise ValueError(
+                f"{filepath} changed since {result_filepath} was made; score it again."
+            )
+
+        registry = self.refresh()
+        current = {model.name: model for model in registry.models()}
+        recorded: Dict[str, str] = manifest["models"]
+        gone = [name for name in recorded if name not in current]
+        if gone:
+            logging.warning("Models no longer present, columns left as they are: %s", gone)
+        schema = self.schema()
+        if schema.fingerprint != manifest["schema"]:
+            logging.info("Preprocessing schema changed; re-scoring every model")
+            changed = [name for name in recorded if name in current]
+        else:
+            changed = [
+                name
+                for name, sha256 in recorded.items()
+                if name in current and current[name].sha256 != sha256
+            ]
+        kept = [current[name] for name in recorded if name in current]
+        details = dict(
+            rows=manifest.get("rows"),
+            model_version=registry.layout(kept).version if kept else "",
+            models_run=list(recorded),
+            models_rescored=changed,
+            output_format=manifest["output_format"],
+            statistics=manifest.get("statistics"),
+        )
+        if not changed:
+            logging.info("%s is up to date with the model files", result_filepath)
+            if run_info is not None:
+                run_info.update(details)
+            return result_filepath, manifest.get("summary", {})
+
+        models = [current[name] for name in changed]
+        layout = registry.layout(models)
+        logging.info("Re-scoring %s with %d changed models", result_filepath, len(models))
+        patcher = _ResultPatcher(
+            result_filepath,
+            manifest["output_format"],
+            list(recorded),
+            changed,
+            chunksize,
+            compression=manifest.get("compression"),
+            precision=manifest.get("precision"),
+        )
+        try:
+            if filepath.lower().endswith(NPY_EXTENSIONS):
+                outcome = self._score_npy(filepath, patcher, models, layout, chunksize, progress)
+            else:
+                outcome = self._score_stream(
+                    self.iter_input_frames(filepath, layout, chunksize),
+                    patcher,
+                    models,
+                    layout,
+                    progress=progress,
+                )
+            patcher.commit()
+        finally:
+            patcher.close()
+        if manifest.get("contributions_file"):
+            logging.warning(
+                "%s still holds contributions of the previous models",
+                manifest["contributions_file"],
+            )
+
+        summary = patcher.accumulator.summary()
+        statistics = patcher.accumulator.statistics()
+        manifest["models"] = dict(recorded, **{model.name: model.sha256 for model in models})
+        manifest.update(
+            schema=schema.fingerprint,
+            rows=outcome[0],
+            summary=summary,
+            statistics=statistics,
+            updated_at=time.time(),
+        )
+        _write_manifest(result_filepath, manifest)
+        details.update(rows=outcome[0], missing_features=outcome[1], statistics=statistics)
+        if run_info is not None:
+            run_info.update(details)
+        return result_filepath, summary
+
+
+@dataclass(frozen=True)
+class _Shard:
+    """
+    One contiguous row range of an input file.
+
+    For CSV ``start``/``stop`` are byte offsets of whole lines after the
+    header; for Parquet they are row-group indices.
+    """
+
+    index: int
+    filepath: str
+    start: int
+    stop: int
+    first_row: int
+    part_path: str
+    model_version: str
+    model_names: Tuple[str, ...]
+    compression: Optional[str] = None
+    precision: Optional[int] = None
+
+
+def _csv_shard_ranges(filepath: str, count: int) -> List[Tuple[int, int, int]]:
+    """
+    Split a CSV body into ``count`` byte ranges that start and end on line breaks.
+
+    Records are assumed to be one line each (no quoted newlines). Row offsets
+    are only counted when the file has no ``eid`` column, since they are only
+    needed for ``row_id``.
+    """
+    import csv  # noqa: PLC0415
+
+    size = os.path.getsize(filepath)
+    with open(filepath, "rb") as handle:
+        header = handle.readline()
+        boundaries = [handle.tell()]
+        for index in range(1, count):
+            target = boundaries[0] + (size - boundaries[0]) * index // count
+            handle.seek(max(target, boundaries[-1]))
+            handle.readline()
+            position = handle.tell()
+            if position >= size:
+                break
+            if position > boundaries[-1]:
+                boundaries.append(position)
+        boundaries.append(size)
+
+        names = next(csv.reader([header.decode("utf-8-sig", errors="replace")]), [])
+        first_rows = [0] * (len(boundaries) - 1)
+        if "eid" not in (name.strip() for name in names):
+            for index in range(1, len(first_rows)):
+                start, stop = boundaries[index - 1], boundaries[index]
+                handle.seek(start)
+                lines = 0
+                while start < stop:
+                    block = handle.read(min(1 << 20, stop - start))
+                    lines += block.count(b"\n")
+                    start += len(block)
+                first_rows[index] = first_rows[index - 1] + lines
+
+    return [
+        (boundaries[index], boundaries[index + 1], first_rows[index])
+        for index in range(len(first_rows))
+        if boundaries[index + 1] > boundaries[index]
+    ]
+
+
+def _parquet_shard_ranges(filepath: str, count: int) -> List[Tuple[int, int, int]]:
+    """Split a Parquet file's row groups into up to ``count`` contiguous runs."""
+    _require_pyarrow()
+    import pyarrow.parquet as pq  # noqa: PLC0415
+
+    metadata = pq.ParquetFile(filepath, memory_map=True).metadata
+    groups = metadata.num_row_groups
+    count = min(count, groups)
+    ranges = []
+    first_row = 0
+    for index in range(count):
+        start, stop = groups * index // count, groups * (index + 1) // count
+        ranges.append((start, stop, first_row))
+        first_row += sum(metadata.row_group(group).num_rows for group in range(start, stop))
+    return ranges
+
+
+def _shard_ranges(filepath: str, count: int) -> List[Tuple[int, int, int]]:
+    lower = filepath.lower()
+    if lower.endswith(".csv"):
+        return _csv_shard_ranges(filepath, count)
+    if lower.endswith(PARQUET_EXTENSIONS):
+        return _parquet_shard_ranges(filepath, count)
+    return []
+
+
+def _iter_shard_frames(
+    shard: _Shard,
+    chunksize: Optional[int],
+    columns: List[str],
+    float_columns: List[str],
+) -> Iterator[pd.DataFrame]:
+    if shard.filepath.lower().endswith(PARQUET_EXTENSIONS):
+        pa = _require_pyarrow()
+        import pyarrow.parquet as pq  # noqa: PLC0415
+
+        parquet_file = pq.ParquetFile(shard.filepath, memory_map=True)
+        wanted = set(columns)
+        selected = [name for name in parquet_file.schema_arrow.names if name in wanted]
+        row_groups = list(range(shard.start, shard.stop))
+        if chunksize:
+            for batch in parquet_file.iter_batches(
+                batch_size=chunksize, row_groups=row_groups, columns=selected
+            ):
+                yield _arrow_to_pandas(pa.Table.from_batches([batch]))
+        else:
+            yield _arrow_to_pandas(parquet_file.read_row_groups(row_groups, columns=selected))
+        return
+
+    wanted = set(columns)
+    # Stream the shard's byte range; only the parser's buffer is held at once.
+    with io.BufferedReader(
+        _ShardReader(shard.filepath, shard.start, shard.stop), buffer_size=1 << 20
+    ) as source:
+        yield from _iter_csv_frames(source, chunksize, lambda name: name in wanted, float_columns)
+
+
+class _ShardReader(io.RawIOBase):
+    """A CSV file's header line followed by its bytes ``[start, stop)``, read on demand."""
+
+    def __init__(self, path: str, start: int, stop: int):
+        self._file = open(path, "rb")
+        self._header = self._file.readline()
+        self._start = start
+        self._length = len(self._header) + stop - start
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        view = memoryview(buffer).cast("B")
+        wanted = min(len(view), self._length - self._position)
+        if wanted <= 0:
+            return 0
+        header_length = len(self._header)
+        if self._position < header_length:
+            count = min(wanted, header_length - self._position)
+            view[:count] = self._header[self._position : self._position + count]
+        else:
+            self._file.seek(self._start + self._position - header_length)
+            count = self._file.readinto(view[:wanted]) or 0
+        self._position += count
+        return count
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._position, io.SEEK_END: self._length}[whence]
+        self._position = max(0, base + offset)
+        return self._position
+
+    def tell(self) -> int:
+        return self._position
+
+    def close(self) -> None:
+        if not self.closed:
+            self._file.close()
+        super().close()
+
+
+_shard_settings: Optional[EngineSettings] = None
+
+
+def _init_shard_worker(settings: EngineSettings) -> None:
+    """Process-pool initializer: make the models resident once per shard worker."""
+    global _shard_settings
+    _shard_settings = settings
+    get_engine(settings).warm_up()
+
+
+def _score_shard(
+    shard: _Shard, chunksize: Optional[int], output_format: str
+) -> Tuple[int, List[str], _SummaryAccumulator]:
+    engine = get_engine(_shard_settings)
+    registry = engine.refresh()
+    models = [model for model in registry.models() if model.name in shard.model_names]
+    layout = registry.layout(models)
+    if layout.version != shard.model_version:
+        raise RuntimeError("The model set changed while the shards were being scored.")
+    columns, float_columns = _read_plan(layout, engine.schema())
+    writer = _ResultWriter(
+        shard.part_path,
+        output_format,
+        [model.name for model in models],
+        header=shard.index == 0,
+        compression=shard.compression,
+        precision=shard.precision,
+    )
+    try:
+        outcome = engine._score_stream(
+            _iter_shard_frames(shard, chunksize, columns, float_columns),
+            writer,
+            models,
+            layout,
+            first_row=shard.first_row,
+        )
+        writer.commit()
+        return outcome
+    finally:
+        writer.close()
+
+
+def _merge_parts(
+    parts: List[str], result_filepath: str, output_format: str, compression: Optional[str] = None
+) -> None:
+    """
+    Concatenate shard outputs in order (CSV bytes as-is, Parquet/Feather table by table).
+
+    Compressed CSV parts are concatenated too: gzip members and zstd frames
+    decode back to back as one stream.
+    """
+    parts = [part for part in parts if os.path.exists(part)]
+    partial = _partial_path(result_filepath)
+    try:
+        _concatenate_parts(parts, partial, output_format, compression)
+        os.replace(partial, result_filepath)
+    finally:
+        if os.path.exists(partial):
+            os.unlink(partial)
+
+
+def _concatenate_parts(
+    parts: List[str], target_path: str, output_format: str, compression: Optional[str]
+) -> None:
+    if output_format == "csv":
+        with open(target_path, "wb") as target:
+            for part in parts:
+                with open(part, "rb") as source:
+                    shutil.copyfileobj(source, target, 1 << 20)
+        return
+
+    pa = _require_pyarrow()
+    writer = None
+    try:
+        for part in parts:
+            if output_format == "parquet":
+                import pyarrow.parquet as pq  # noqa: PLC0415
+
+                table = pq.read_table(part, memory_map=True)
+            else:
+                with pa.memory_map(part, "r") as source:
+                    table = pa.ipc.open_file(source).read_all()
+            if writer is None:
+                writer = _open_table_writer(target_path, output_format, table.schema, compression)
+            writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+_engines: Dict[EngineSettings, ScoringEngine] = {}
+_engines_lock = threading.Lock()
+
+
+def get_engine(settings: EngineSettings) -> ScoringEngine:
+    """Return the process-wide engine for ``settings`` (one per distinct configuration)."""
+    with _engines_lock:
+        engine = _engines.get(settings)
+        if engine is None:
+            engine = _engines[settings] = ScoringEngine(settings)
+        return engine
+
+
+def predict_with_models(
+    filepath: str,
+    user_dir: str,
+    model_dir: Optional[str] = None,
+    **options,
+):
+    """
+    Score ``filepath`` with every model in ``model_dir``; see ``ScoringEngine.predict_file``.
+
+    Engine settings other than the model directory come from the MEDLI_*
+    environment variables.
+    """
+    engine = get_engine(EngineSettings.from_env(model_dir))
+    return engine.predict_file(filepath, user_dir, **options)
+
+
+class MicroBatcher:
+    """
+    Coalesce in-memory scoring requests into one matrix per booster.
+
+    A single dispatcher thread takes the first waiting request, keeps
+    collecting for ``window_seconds`` (or until ``max_rows``), and hands the
+    collected tables to ``ScoringEngine.score_frames``, one call per distinct
+    model selection (and contributions depth) in the batch.
+    """
+
+    def __init__(self, engine: ScoringEngine, window_seconds: float, max_rows: int):
+        self.engine = engine
+        self.window_seconds = max(0.0, window_seconds)
+        self.max_rows = max(1, int(max_rows))
+        self._queue: "queue.Queue[tuple]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def score(
+        self,
+        frame: pd.DataFrame,
+        timeout: Optional[float] = None,
+        selection: Optional[ModelSelection] = None,
+        top_k: int = 0,
+    ):
+        """
+        Return (model names, {model: predictions or None}, {model: per-row contributions}).
+
+        Contributions are only computed when ``top_k`` is set.
+        """
+        future: Future = Future()
+        self._ensure_started()
+        self._queue.put((frame, future, (selection or ModelSelection(), top_k)))
+        return future.result(timeout=timeout)
+
+    def _ensure_started(self) -> None:
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._loop, name="score-batcher", daemon=True
+                )
+                self._thread.start()
+
+    def _loop(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            rows = len(batch[0][0])
+            deadline = time.monotonic() + self.window_seconds
+            while rows < self.max_rows:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                batch.append(item)
+                rows += len(item[0])
+            self._dispatch(batch)
+
+    def _dispatch(self, batch: List[tuple]) -> None:
+        groups: Dict[Tuple[ModelSelection, int], List[tuple]] = {}
+        for item in batch:
+            groups.setdefault(item[2], []).append(item)
+        for (selection, top_k), items in groups.items():
+            try:
+                names, per_frame, per_frame_contributions = self.engine.score_frames(
+                    [frame for frame, _, _ in items], selection, top_k
+                )
+            except Exception as err:  # noqa: BLE001
+                for _, future, _ in items:
+                    future.set_exception(err)
+                continue
+            for (_, future, _), predictions, contributions in zip(
+                items, per_frame, per_frame_contributions
+            ):
+                future.set_result((names, predictions, contributions))
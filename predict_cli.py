@@ -4,11 +4,43 @@
 from __future__ import annotations
 
 import argparse
+import glob
 import json
+import logging
+import os
+import socketserver
 import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
+from typing import Iterator, List, Optional, TextIO
 
-from app_lightgbm_service import predict_with_models
+from lightgbm_engine import (
+    INPUT_EXTENSIONS,
+    COMPRESSIONS,
+    OUTPUT_FORMATS,
+    EngineSettings,
+    ModelSelection,
+    ScoringEngine,
+    get_engine,
+    manifest_path,
+    read_manifest,
+)
+
+
+def get_cli_engine(model_dir: Optional[Path] = None) -> ScoringEngine:
+    """Engine for ``model_dir`` (or MEDLI_MODEL_DIR / the default model directory)."""
+    return get_engine(EngineSettings.from_env(str(model_dir) if model_dir else None))
+
+
+def check_selection(selection: ModelSelection, model_dir: Optional[Path] = None) -> None:
+    """Raise ValueError for a term that names no model or tag, before anything is scored."""
+    if not selection:
+        return
+    registry = get_cli_engine(model_dir).registry
+    names = sorted(registry.digests())
+    if names:
+        selection.names(names, registry.tags())
 
 
 def configure_windows_encoding() -> None:
@@ -20,32 +52,548 @@ def configure_windows_encoding() -> None:
         sys.stderr = codecs.getwriter("utf-8")(sys.stderr.buffer, "strict")
 
 
+def run_prediction(
+    file_path: Path,
+    output_dir: Optional[Path] = None,
+    chunksize: Optional[int] = None,
+    output_format: str = "csv",
+    model_dir: Optional[Path] = None,
+    workers: Optional[int] = None,
+    selection: Optional[ModelSelection] = None,
+    contributions: int = 0,
+    compression: Optional[str] = None,
+    precision: Optional[int] = None,
+) -> dict:
+    """Score one file and return the JSON-ready result printed by the CLI."""
+    if not file_path.exists():
+        raise FileNotFoundError(f"Input file {file_path} does not exist.")
+
+    target_dir = output_dir or file_path.parent
+    target_dir.mkdir(parents=True, exist_ok=True)
+
+    run_info: dict = {}
+    started = time.perf_counter()
+    result_path, summary = get_cli_engine(model_dir).predict_file(
+        filepath=str(file_path),
+        user_dir=str(target_dir),
+        chunksize=chunksize,
+        output_format=output_format,
+        run_info=run_info,
+        workers=workers,
+        selection=selection,
+        contributions=contributions,
+        compression=compression,
+        precision=precision,
+    )
+    return {
+        "resultPath": result_path,
+        "summary": summary,
+        "statistics": run_info.get("statistics"),
+        "missingFeatures": run_info.get("missing_features", []),
+        "modelsRun": run_info.get("models_run", []),
+        "contributionsFile": run_info.get("contributions_file"),
+        "rows": run_info.get("rows"),
+        "cache": run_info.get("cache"),
+        "seconds": round(time.perf_counter() - started, 3),
+    }
+
+
+def expand_inputs(paths: List[str]) -> List[Path]:
+    """
+    Resolve files, glob patterns and directories into a sorted, de-duplicated file list.
+
+    Directories contribute their supported input files (not recursively),
+    skipping ``predictions_*`` artifacts from earlier runs.
+    """
+    found: List[Path] = []
+    for raw in paths:
+        if glob.has_magic(raw):
+            matches = sorted(glob.glob(raw))
+        elif os.path.isdir(raw):
+            matches = sorted(
+                entry.path
+                for entry in os.scandir(raw)
+                if entry.is_file()
+                and entry.name.lower().endswith(INPUT_EXTENSIONS)
+                and not entry.name.startswith("predictions_")
+            )
+        else:
+            matches = [raw]
+        if not matches:
+            logging.warning("No input files matched %s", raw)
+        found.extend(Path(match) for match in matches)
+    return list(dict.fromkeys(found))
+
+
+def expand_predictions(paths: List[str]) -> List[Path]:
+    """Prediction files named by ``paths``; directories contribute those with a manifest."""
+    found: List[Path] = []
+    for raw in paths:
+        if os.path.isdir(raw):
+            matches = sorted(
+                entry.path
+                for entry in os.scandir(raw)
+                if entry.is_file()
+                and entry.name.startswith("predictions_")
+                and os.path.exists(manifest_path(entry.path))
+            )
+        else:
+            matches = sorted(glob.glob(raw)) if glob.has_magic(raw) else [raw]
+        if not matches:
+            logging.warning("No prediction files matched %s", raw)
+        found.extend(Path(match) for match in matches)
+    return list(dict.fromkeys(found))
+
+
+def default_store_path() -> Optional[str]:
+    """
+    The service's prediction store: MEDLI_PREDICTION_STORE ("" disables it),
+    else the default store file if the service has created one.
+    """
+    from prediction_store import DEFAULT_STORE_PATH  # noqa: PLC0415
+
+    path = os.getenv("MEDLI_PREDICTION_STORE")
+    if path is not None:
+        return path or None
+    return str(DEFAULT_STORE_PATH) if DEFAULT_STORE_PATH.exists() else None
+
+
+def _store_rescored(store_path: str, result_path: Path, run_info: dict) -> Optional[int]:
+    """
+    Record the re-scored columns in the store as a new run; a failure is only logged.
+
+    The run is filed under the prediction file's directory name, which is
+    the username for files under the service's upload folder.
+    """
+    from prediction_store import PredictionStore  # noqa: PLC0415
+
+    try:
+        return PredictionStore(store_path).ingest(
+            str(result_path),
+            result_path.resolve().parent.name,
+            os.path.basename(read_manifest(str(result_path))["input"]),
+            run_info["model_version"],
+            run_info["models_rescored"],
+            output_format=run_info["output_format"],
+        )
+    except Exception:  # noqa: BLE001
+        logging.exception("Could not store re-scored predictions from %s", result_path)
+        return None
+
+
+def rescore_prediction(
+    result_path: Path,
+    chunksize: Optional[int] = None,
+    model_dir: Optional[Path] = None,
+    store_path: Optional[str] = None,
+) -> dict:
+    """
+    Re-run only the retrained models on one prediction file; failures are reported.
+
+    With ``store_path`` the re-scored columns are also recorded in that
+    prediction store as a new run, so its latest scores follow the file.
+    """
+    started = time.perf_counter()
+    try:
+        run_info: dict = {}
+        _, summary = get_cli_engine(model_dir).rescore_file(
+            str(result_path), chunksize=chunksize, run_info=run_info
+        )
+    except Exception as err:  # noqa: BLE001
+        logging.exception("Re-scoring failed for %s", result_path)
+        return {
+            "file": str(result_path),
+            "ok": False,
+            "error": str(err),
+            "seconds": round(time.perf_counter() - started, 3),
+        }
+    store_run_id = None
+    if store_path and run_info.get("models_rescored"):
+        store_run_id = _store_rescored(store_path, result_path, run_info)
+    return {
+        "file": str(result_path),
+        "ok": True,
+        "summary": summary,
+        "statistics": run_info.get("statistics"),
+        "modelsRescored": run_info.get("models_rescored", []),
+        "rows": run_info.get("rows") if run_info.get("models_rescored") else 0,
+        "storeRunId": store_run_id,
+        "seconds": round(time.perf_counter() - started, 3),
+    }
+
+
+def _init_worker(model_dir: Optional[Path], cpu_budget: int) -> None:
+    """Process-pool initializer: load every model once per worker."""
+    os.environ["MEDLI_CPU_BUDGET"] = str(cpu_budget)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+    get_cli_engine(model_dir).warm_up()
+
+
+def _score_one(
+    file_path: Path,
+    output_dir: Optional[Path],
+    chunksize: Optional[int],
+    output_format: str,
+    model_dir: Optional[Path],
+    workers: Optional[int] = None,
+    selection: Optional[ModelSelection] = None,
+    contributions: int = 0,
+    compression: Optional[str] = None,
+    precision: Optional[int] = None,
+) -> dict:
+    """Score one file of a batch; failures are reported in the result instead of raised."""
+    started = time.perf_counter()
+    try:
+        result = run_prediction(
+            file_path,
+            output_dir,
+            chunksize,
+            output_format,
+            model_dir,
+            workers=workers,
+            selection=selection,
+            contributions=contributions,
+            compression=compression,
+            precision=precision,
+        )
+        return {"file": str(file_path), "ok": True, **result}
+    except Exception as err:  # noqa: BLE001
+        logging.exception("Prediction failed for %s", file_path)
+        return {
+            "file": str(file_path),
+            "ok": False,
+            "error": str(err),
+            "seconds": round(time.perf_counter() - started, 3),
+        }
+
+
+def run_batch(files: List[Path], args: argparse.Namespace) -> Iterator[dict]:
+    """
+    Yield one result per file, in input order, scored in-process or on ``args.jobs`` workers.
+
+    Each worker loads the models once and gets an equal share of the CPU
+    budget, so the pool does not oversubscribe the machine. Row sharding
+    (``--workers``) only applies when the files are scored in-process.
+    """
+    options = (args.output_dir, args.chunksize, args.output_format, args.model_dir)
+    selection = ModelSelection.parse(args.models, args.exclude_models)
+    output = dict(compression=args.compression, precision=args.precision)
+    jobs = max(1, min(args.jobs, len(files)))
+    if jobs == 1:
+        get_cli_engine(args.model_dir).warm_up()
+        for file_path in files:
+            yield _score_one(
+                file_path,
+                *options,
+                workers=args.workers,
+                selection=selection,
+                contributions=args.contributions,
+                **output,
+            )
+        return
+
+    cpu_budget = int(os.getenv("MEDLI_CPU_BUDGET", str(os.cpu_count() or 1)))
+    with ProcessPoolExecutor(
+        max_workers=jobs,
+        initializer=_init_worker,
+        initargs=(args.model_dir, max(1, cpu_budget // jobs)),
+    ) as pool:
+        futures = [
+            pool.submit(
+                _score_one,
+                file_path,
+                *options,
+                selection=selection,
+                contributions=args.contributions,
+                **output,
+            )
+            for file_path in files
+        ]
+        for future in futures:
+            yield future.result()
+
+
+def aggregate_report(results: List[dict], seconds: float) -> dict:
+    """Throughput over a batch run, printed as the final JSON line."""
+    rows = sum(result.get("rows") or 0 for result in results if result["ok"])
+    succeeded = sum(result["ok"] for result in results)
+    return {
+        "aggregate": {
+            "files": len(results),
+            "succeeded": succeeded,
+            "failed": len(results) - succeeded,
+            "rows": rows,
+            "seconds": round(seconds, 3),
+            "filesPerSecond": round(len(results) / seconds, 3) if seconds else None,
+            "rowsPerSecond": round(rows / seconds, 1) if seconds else None,
+        }
+    }
+
+
+def handle_request(line: str, defaults: argparse.Namespace) -> str:
+    """
+    Answer one newline-delimited JSON request with one JSON line.
+
+    Request: ``{"id": ..., "file_path": ..., "output_dir": ..., "chunksize": ...,
+    "output_format": ...}``; only ``file_path`` is required. The reply echoes
+    ``id`` and carries either the usual result fields or ``error``. ``models``,
+    ``exclude_models``, ``compression`` and ``precision`` work as on the
+    command line.
+    """
+    request_id = None
+    try:
+        request = json.loads(line)
+        if not isinstance(request, dict) or not request.get("file_path"):
+            raise ValueError("Request must be a JSON object with a file_path.")
+        request_id = request.get("id")
+        output_dir = request.get("output_dir") or defaults.output_dir
+        output_format = request.get("output_format", defaults.output_format)
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(f"Unsupported output_format: {output_format}")
+        response = run_prediction(
+            Path(request["file_path"]),
+            output_dir=Path(output_dir) if output_dir else None,
+            chunksize=request.get("chunksize", defaults.chunksize),
+            output_format=output_format,
+            model_dir=defaults.model_dir,
+            workers=request.get("workers", defaults.workers),
+            selection=ModelSelection.parse(
+                request.get("models", defaults.models),
+                request.get("exclude_models", defaults.exclude_models),
+            ),
+            contributions=int(request.get("contributions", defaults.contributions) or 0),
+            compression=request.get("compression", defaults.compression),
+            precision=request.get("precision", defaults.precision),
+        )
+        response = {"id": request_id, "ok": True, **response}
+    except Exception as err:  # noqa: BLE001
+        logging.exception("Prediction request failed")
+        response = {"id": request_id, "ok": False, "error": str(err)}
+    return json.dumps(response, ensure_ascii=False)
+
+
+def serve_stream(stream_in: TextIO, stream_out: TextIO, defaults: argparse.Namespace) -> None:
+    for line in stream_in:
+        if not line.strip():
+            continue
+        stream_out.write(handle_request(line, defaults) + "\n")
+        stream_out.flush()
+
+
+def serve_socket(socket_path: str, defaults: argparse.Namespace) -> None:
+    class RequestHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for raw in self.rfile:
+                if not raw.strip():
+                    continue
+                reply = handle_request(raw.decode("utf-8"), defaults) + "\n"
+                self.wfile.write(reply.encode("utf-8"))
+                self.wfile.flush()
+
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    with socketserver.ThreadingUnixStreamServer(socket_path, RequestHandler) as server:
+        server.daemon_threads = True
+        logging.info("Serving predictions on %s", socket_path)
+        try:
+            server.serve_forever()
+        finally:
+            os.unlink(socket_path)
+
+
 def main() -> int:
     parser = argparse.ArgumentParser(
-        description="Run every LightGBM model on the given CSV/Excel file."
+        description="Run every LightGBM model on the given CSV/Excel/Parquet/Feather/.npy file."
+    )
+    parser.add_argument(
+        "file_paths",
+        nargs="*",
+        help=(
+            "Input CSV/XLS/XLSX/Parquet/Feather/.npy files, glob patterns or directories. "
+            "With more than one file, one JSON line is printed per file followed by "
+            "an aggregate throughput line."
+        ),
     )
-    parser.add_argument("file_path", type=Path, help="Path to an input CSV/XLS/XLSX file.")
     parser.add_argument(
         "--output-dir",
         type=Path,
         default=None,
         help="Directory for prediction artifacts (default: same as the input file).",
     )
+    parser.add_argument(
+        "--chunksize",
+        type=int,
+        default=None,
+        help=(
+            "Stream CSV/Parquet/Feather input in chunks of this many rows "
+            "(default: read the whole file)."
+        ),
+    )
+    parser.add_argument(
+        "--output-format",
+        choices=sorted(OUTPUT_FORMATS),
+        default="csv",
+        help="Format of the predictions file (default: csv).",
+    )
+    parser.add_argument(
+        "--compression",
+        choices=sorted(COMPRESSIONS),
+        default=None,
+        help=(
+            "Compress CSV predictions to .csv.gz/.csv.zst, or set the Parquet/Feather "
+            "codec (default: uncompressed CSV, snappy Parquet)."
+        ),
+    )
+    parser.add_argument(
+        "--precision",
+        type=int,
+        default=None,
+        metavar="DIGITS",
+        help="Write CSV scores with this many significant digits (default: full float32).",
+    )
+    parser.add_argument(
+        "--model-dir",
+        type=Path,
+        default=None,
+        help="Directory with the *.model files (default: MEDLI_MODEL_DIR, 17_models or models).",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Worker processes for multi-file runs; each loads the models once (default: 1).",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help=(
+            "Cohort mode: split each CSV/Parquet input into this many row shards, "
+            "scored by separate processes and merged in row order."
+        ),
+    )
+    parser.add_argument(
+        "--models",
+        default=None,
+        help=(
+            "Comma-separated model names, disease-code suffixes or tags "
+            "(from model_tags.json) to run (default: every model)."
+        ),
+    )
+    parser.add_argument(
+        "--exclude-models",
+        default=None,
+        help="Comma-separated model names, suffixes or tags to skip.",
+    )
+    parser.add_argument(
+        "--contributions",
+        type=int,
+        default=0,
+        metavar="K",
+        help=(
+            "Also compute pred_contrib in the same pass and save each row's K strongest "
+            "features per model to contributions_<input>.npz (default: off)."
+        ),
+    )
+    parser.add_argument(
+        "--rescore",
+        action="store_true",
+        help=(
+            "Treat the paths as earlier prediction files (or directories of them) and "
+            "re-run only the models whose files changed since, patching their columns."
+        ),
+    )
+    parser.add_argument(
+        "--store",
+        default=None,
+        help=(
+            "With --rescore, prediction store (SQLite) to record the re-scored columns in "
+            "(default: MEDLI_PREDICTION_STORE, or the service's store if it exists; "
+            "'' to skip)."
+        ),
+    )
+    parser.add_argument(
+        "--serve",
+        action="store_true",
+        help=(
+            "Stay resident with models loaded and answer newline-delimited JSON "
+            "requests on stdin (or --socket), one JSON line per request."
+        ),
+    )
+    parser.add_argument(
+        "--socket",
+        default=None,
+        help="With --serve, listen on this Unix domain socket instead of stdin/stdout.",
+    )
     args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
 
-    if not args.file_path.exists():
-        parser.error(f"Input file {args.file_path} does not exist.")
+    if args.serve:
+        get_cli_engine(args.model_dir).warm_up()
+        if args.socket:
+            serve_socket(args.socket, args)
+        else:
+            serve_stream(sys.stdin, sys.stdout, args)
+        return 0
 
-    target_dir = args.output_dir or args.file_path.parent
-    target_dir.mkdir(parents=True, exist_ok=True)
+    if not args.file_paths:
+        parser.error("at least one input file is required unless --serve is given.")
 
-    result_path, summary = predict_with_models(
-        filepath=str(args.file_path),
-        user_dir=str(target_dir),
+    if args.rescore:
+        files = expand_predictions(args.file_paths)
+        if not files:
+            parser.error("No prediction files matched.")
+        get_cli_engine(args.model_dir).warm_up()
+        store_path = default_store_path() if args.store is None else args.store or None
+        started = time.perf_counter()
+        results = []
+        for result_path in files:
+            result = rescore_prediction(result_path, args.chunksize, args.model_dir, store_path)
+            results.append(result)
+            print(json.dumps(result, ensure_ascii=False), flush=True)
+        report = aggregate_report(results, time.perf_counter() - started)
+        print(json.dumps(report, ensure_ascii=False), flush=True)
+        return 0 if report["aggregate"]["failed"] == 0 else 1
+
+    selection = ModelSelection.parse(args.models, args.exclude_models)
+    try:
+        check_selection(selection, args.model_dir)
+    except ValueError as err:
+        parser.error(str(err))
+
+    single = len(args.file_paths) == 1 and not (
+        glob.has_magic(args.file_paths[0]) or os.path.isdir(args.file_paths[0])
     )
-    print(json.dumps({"resultPath": result_path, "summary": summary}, ensure_ascii=False))
-    return 0
+    if single:
+        file_path = Path(args.file_paths[0])
+        if not file_path.exists():
+            parser.error(f"Input file {file_path} does not exist.")
+        result = run_prediction(
+            file_path,
+            output_dir=args.output_dir,
+            chunksize=args.chunksize,
+            output_format=args.output_format,
+            model_dir=args.model_dir,
+            workers=args.workers,
+            selection=selection,
+            contributions=args.contributions,
+            compression=args.compression,
+            precision=args.precision,
+        )
+        print(json.dumps(result, ensure_ascii=False))
+        return 0
 
+    files = expand_inputs(args.file_paths)
+    if not files:
+        parser.error("No input files matched.")
+    started = time.perf_counter()
+    results = []
+    for result in run_batch(files, args):
+        results.append(result)
+        print(json.dumps(result, ensure_ascii=False), flush=True)
+    report = aggregate_report(results, time.perf_counter() - started)
+    print(json.dumps(report, ensure_ascii=False), flush=True)
+    return 0 if report["aggregate"]["failed"] == 0 else 1
 
 if __name__ == "__main__":
     configure_windows_encoding()
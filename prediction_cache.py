@@ -0,0 +1,129 @@
+"""Content-addressed, size-bounded LRU cache of prediction artifacts on local disk."""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+META_FILENAME = "meta.json"
+
+
+@dataclass
+class CacheEntry:
+    """A cached prediction run: the stored result file plus what the run returned."""
+
+    key: str
+    result_path: str
+    summary: Dict[str, float]
+    run_info: dict
+
+
+def file_digest(path: str) -> str:
+    """SHA-256 of a file's content, read in 1 MiB blocks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as handle:
+        for block in iter(lambda: handle.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class PredictionCache:
+    """
+    Prediction files keyed by input content hash plus model-set fingerprint.
+
+    Each entry is a directory ``<root>/<key[:2]>/<key>`` holding the result
+    file and ``meta.json``. The mtime of ``meta.json`` is bumped on every hit
+    and entries are evicted oldest-first once the cache exceeds ``max_bytes``.
+    """
+
+    def __init__(self, root: str, max_bytes: int):
+        self.root = str(root)
+        self.max_bytes = int(max_bytes)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(input_digest: str, model_version: str, **options) -> str:
+        payload = json.dumps(
+            {"input": input_digest, "models": model_version, "options": options},
+            sort_keys=True,
+            default=str,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _entry_dir(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], key)
+
+    def get(self, key: str) -> Optional[CacheEntry]:
+        entry_dir = self._entry_dir(key)
+        meta_path = os.path.join(entry_dir, META_FILENAME)
+        try:
+            with open(meta_path, "r", encoding="utf-8") as handle:
+                meta = json.load(handle)
+            result_path = os.path.join(entry_dir, meta["result_file"])
+            if not os.path.exists(result_path):
+                return None
+            os.utime(meta_path)
+        except (OSError, ValueError, KeyError):
+            return None
+        return CacheEntry(
+            key=key,
+            result_path=result_path,
+            summary=meta.get("summary", {}),
+            run_info=meta.get("run_info", {}),
+        )
+
+    def put(self, key: str, result_path: str, summary: Dict[str, float], run_info: dict) -> None:
+        """Store a copy of ``result_path`` under ``key`` and evict down to ``max_bytes``."""
+        entry_dir = self._entry_dir(key)
+        if os.path.exists(entry_dir):
+            return
+        os.makedirs(os.path.dirname(entry_dir), exist_ok=True)
+        staging = tempfile.mkdtemp(prefix=".staging-", dir=os.path.dirname(entry_dir))
+        try:
+            result_file = os.path.basename(result_path)
+            shutil.copyfile(result_path, os.path.join(staging, result_file))
+            with open(os.path.join(staging, META_FILENAME), "w", encoding="utf-8") as handle:
+                json.dump(
+                    {"result_file": result_file, "summary": summary, "run_info": run_info},
+                    handle,
+                )
+            os.rename(staging, entry_dir)
+        except OSError:
+            # Another process may have stored the same key concurrently.
+            shutil.rmtree(staging, ignore_errors=True)
+            if not os.path.exists(entry_dir):
+                raise
+            return
+        self.evict()
+
+    def evict(self) -> None:
+        with self._lock:
+            entries = []
+            total = 0
+            for bucket in os.scandir(self.root):
+                if not bucket.is_dir():
+                    continue
+                for entry in os.scandir(bucket.path):
+                    if entry.name.startswith("."):
+                        continue
+                    try:
+                        size = sum(item.stat().st_size for item in os.scandir(entry.path))
+                        used = os.stat(os.path.join(entry.path, META_FILENAME)).st_mtime
+                    except OSError:
+                        continue
+                    entries.append((used, size, entry.path))
+                    total += size
+
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                shutil.rmtree(path, ignore_errors=True)
+                total -= size
+                logging.info("Evicted prediction cache entry %s", os.path.basename(path))
@@ -0,0 +1,192 @@
+"""Embedded SQLite store of predictions, indexed for per-participant lookups."""
+
+from __future__ import annotations
+
+import logging
+import os
+import sqlite3
+import time
+from contextlib import closing
+from itertools import repeat
+from typing import Dict, List, Optional
+
+from lightgbm_engine import BASE_DIR, PERCENTILE_SUFFIX, iter_prediction_frames
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY,
+    username TEXT NOT NULL,
+    source_file TEXT NOT NULL,
+    result_file TEXT NOT NULL,
+    model_version TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS predictions (
+    run_id INTEGER NOT NULL REFERENCES runs(run_id) ON DELETE CASCADE,
+    eid TEXT NOT NULL,
+    model TEXT NOT NULL,
+    score REAL,
+    percentile REAL,
+    model_version TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS predictions_eid_model_time
+    ON predictions (eid, model, created_at);
+CREATE INDEX IF NOT EXISTS predictions_version ON predictions (model_version);
+CREATE INDEX IF NOT EXISTS predictions_run ON predictions (run_id);
+"""
+INGEST_CHUNK_ROWS = 50_000
+DEFAULT_STORE_PATH = BASE_DIR / "data" / "predictions.sqlite3"
+
+
+def _nullable(values) -> list:
+    return [None if value != value else float(value) for value in values]
+
+
+def _eid_label(value) -> Optional[str]:
+    """
+    An eid as written in the input: pandas reads an id column with blanks as
+    floats, so integral floats lose their ".0"; blanks become None.
+    """
+    if value is None or value != value:
+        return None
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value).strip() or None
+
+
+class PredictionStore:
+    """
+    Long-format prediction rows (one per participant and model) in one SQLite file.
+
+    Each scoring run is ingested from its prediction file in a single
+    transaction. Lookups by ``eid`` use the (eid, model, created_at) index.
+    """
+
+    def __init__(self, path: str):
+        self.path = str(path)
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with closing(self._connect()) as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.row_factory = sqlite3.Row
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute("PRAGMA foreign_keys=ON")
+        return connection
+
+    def ingest(
+        self,
+        result_path: str,
+        username: str,
+        source_file: str,
+        model_version: str,
+        model_names: List[str],
+        output_format: str = "csv",
+    ) -> Optional[int]:
+        """
+        Store every row of a prediction file and return the new run id.
+
+        ``output_format`` is the format the file was written in (csv, parquet
+        or feather). Files without an ``eid`` column are skipped (None is
+        returned), as are rows without an eid.
+        """
+        columns = ["eid"]
+        for model in model_names:
+            columns += [model, model + PERCENTILE_SUFFIX]
+
+        created_at = time.time()
+        with closing(self._connect()) as connection, connection:
+            cursor = connection.execute(
+                "INSERT INTO runs (username, source_file, result_file, model_version, created_at)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (username, source_file, os.path.basename(result_path), model_version, created_at),
+            )
+            run_id = cursor.lastrowid
+            rows = skipped = 0
+            for frame in iter_prediction_frames(
+                result_path, output_format, INGEST_CHUNK_ROWS, columns
+            ):
+                if "eid" not in frame.columns:
+                    logging.info("%s has no eid column; not stored", result_path)
+                    connection.rollback()
+                    return None
+                eids = [_eid_label(value) for value in frame["eid"].tolist()]
+                if None in eids:
+                    keep = [eid is not None for eid in eids]
+                    skipped += len(eids) - sum(keep)
+                    frame = frame[keep]
+                    eids = [eid for eid in eids if eid is not None]
+                for model in model_names:
+                    if model not in frame.columns:
+                        continue
+                    scores = _nullable(frame[model].astype("float64"))
+                    percentile_column = model + PERCENTILE_SUFFIX
+                    percentiles = (
+                        _nullable(frame[percentile_column].astype("float64"))
+                        if percentile_column in frame.columns
+                        else repeat(None)
+                    )
+                    connection.executemany(
+                        "INSERT INTO predictions"
+                        " (run_id, eid, model, score, percentile, model_version, created_at)"
+                        " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        zip(
+                            repeat(run_id),
+                            eids,
+                            repeat(model),
+                            scores,
+                            percentiles,
+                            repeat(model_version),
+                            repeat(created_at),
+                        ),
+                    )
+                rows += len(frame)
+        if skipped:
+            logging.warning("%d rows of %s have no eid; not stored", skipped, result_path)
+        logging.info("Stored %d rows of %s as run %d", rows, result_path, run_id)
+        return run_id
+
+    def latest(self, eid: str, model: Optional[str] = None) -> List[Dict]:
+        """The most recent prediction of each model for one participant."""
+        query = (
+            "SELECT p.model, p.score, p.percentile, p.model_version, p.created_at,"
+            " r.run_id, r.username, r.source_file"
+            " FROM predictions p JOIN runs r ON r.run_id = p.run_id"
+            " WHERE p.eid = ? AND p.created_at = ("
+            "   SELECT MAX(created_at) FROM predictions"
+            "   WHERE eid = p.eid AND model = p.model)"
+        )
+        params: list = [str(eid)]
+        if model:
+            query += " AND p.model = ?"
+            params.append(model)
+        with closing(self._connect()) as connection:
+            return [dict(row) for row in connection.execute(query + " ORDER BY p.model", params)]
+
+    def history(
+        self,
+        eid: str,
+        model: Optional[str] = None,
+        since: Optional[float] = None,
+        limit: int = 1000,
+    ) -> List[Dict]:
+        """All predictions for one participant, oldest first."""
+        query = (
+            "SELECT p.model, p.score, p.percentile, p.model_version, p.created_at,"
+            " r.run_id, r.username, r.source_file"
+            " FROM predictions p JOIN runs r ON r.run_id = p.run_id WHERE p.eid = ?"
+        )
+        params: list = [str(eid)]
+        if model:
+            query += " AND p.model = ?"
+            params.append(model)
+        if since is not None:
+            query += " AND p.created_at >= ?"
+            params.append(since)
+        query += " ORDER BY p.created_at, p.model LIMIT ?"
+        params.append(int(limit))
+        with closing(self._connect()) as connection:
+            return [dict(row) for row in connection.execute(query, params)]
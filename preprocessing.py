@@ -0,0 +1,229 @@
+"""Declarative, vectorized input preprocessing for the LightGBM scoring path."""
+
+from __future__ import annotations
+
+import hashlib
+import json
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional, Union
+
+import numpy as np
+import pandas as pd
+
+MissingPolicy = Union[str, float]
+DTYPES = {"float", "int", "bool"}
+
+
+def _fill_value(policy: MissingPolicy) -> float:
+    """Translate a missing/absent policy ("nan", "zero" or a number) into a fill value."""
+    if isinstance(policy, str):
+        if policy == "nan":
+            return float("nan")
+        if policy == "zero":
+            return 0.0
+        raise ValueError(f"Unknown missing-value policy: {policy!r}")
+    return float(policy)
+
+
+@dataclass
+class FeatureSpec:
+    """
+    How one input column becomes a model feature.
+
+    ``categories`` maps labels to numeric codes (labels are matched
+    case-insensitively and ignoring surrounding spaces, or exactly with
+    ``exact_labels``; numeric labels also match numeric cells); values
+    outside the mapping get ``default``. ``scale``/``offset`` convert units,
+    ``dtype`` casts (float, int, bool), ``missing`` fills NaN in a present
+    column and ``absent`` fills a column the input does not have. Both
+    policies accept "nan" (left for LightGBM), "zero" or a number.
+    """
+
+    dtype: str = "float"
+    categories: Optional[Dict[str, float]] = None
+    default: Optional[float] = None
+    exact_labels: bool = False
+    scale: float = 1.0
+    offset: float = 0.0
+    missing: MissingPolicy = "nan"
+    absent: MissingPolicy = "zero"
+
+    def __post_init__(self):
+        if self.dtype not in DTYPES:
+            raise ValueError(f"Unknown dtype {self.dtype!r}; expected one of {sorted(DTYPES)}")
+        _fill_value(self.missing)
+        _fill_value(self.absent)
+
+    @property
+    def is_plain(self) -> bool:
+        return (
+            self.dtype == "float"
+            and not self.categories
+            and self.scale == 1.0
+            and self.offset == 0.0
+            and self.missing == "nan"
+        )
+
+    def _encode_categories(self, column: pd.Series) -> np.ndarray:
+        labels: Dict[str, float] = {}
+        numeric: Dict[float, float] = {}
+        for label, code in self.categories.items():
+            key = str(label) if self.exact_labels else str(label).strip().lower()
+            labels[key] = float(code)
+            try:
+                numeric[float(key)] = float(code)
+                if not self.exact_labels:
+                    labels[str(float(key))] = float(code)
+            except ValueError:
+                pass
+
+        if pd.api.types.is_numeric_dtype(column):
+            encoded = column.astype("float64").map(numeric)
+        else:
+            strings = column.astype("string")
+            if not self.exact_labels:
+                strings = strings.str.strip().str.lower()
+            encoded = strings.map(labels)
+            if self.exact_labels:
+                # Non-string cells of a mixed column (1, 1.0) match numerically.
+                is_text = column.map(lambda value: isinstance(value, str)).astype(bool)
+                numbers = pd.to_numeric(column.where(~is_text), errors="coerce")
+                encoded = encoded.fillna(numbers.astype("float64").map(numeric))
+        if self.default is not None:
+            encoded = encoded.fillna(float(self.default))
+        return encoded.to_numpy(dtype=np.float64, na_value=np.nan)
+
+    def transform(self, column: pd.Series) -> np.ndarray:
+        """Return the encoded column as float32."""
+        if self.categories:
+            values = self._encode_categories(column)
+        else:
+            if not pd.api.types.is_numeric_dtype(column):
+                column = pd.to_numeric(column, errors="coerce")
+            values = column.to_numpy(dtype=np.float64, na_value=np.nan)
+        return self._finish(values)
+
+    def transform_values(self, values: np.ndarray) -> np.ndarray:
+        """Same as :meth:`transform` for an already numeric array."""
+        values = np.asarray(values, dtype=np.float64)
+        if self.categories:
+            values = self._encode_categories(pd.Series(values))
+        return self._finish(values)
+
+    def _finish(self, values: np.ndarray) -> np.ndarray:
+        if self.is_plain:
+            return values.astype(np.float32, copy=False)
+
+        if self.scale != 1.0 or self.offset != 0.0:
+            values = values * self.scale + self.offset
+        if self.dtype == "int":
+            values = np.round(values)
+        elif self.dtype == "bool":
+            values = np.where(np.isnan(values), np.nan, (values != 0).astype(np.float64))
+        fill = _fill_value(self.missing)
+        if fill == fill:
+            values = np.where(np.isnan(values), fill, values)
+        return values.astype(np.float32, copy=False)
+
+
+# Reproduces the historical encoding exactly: "male"/1/"1" -> 1, anything
+# else (including "Male" or " male") -> 0.
+LEGACY_FEATURES = {
+    "sex": FeatureSpec(
+        categories={"male": 1, "1": 1, "female": 0, "0": 0}, default=0, exact_labels=True
+    ),
+}
+
+
+@dataclass
+class PreprocessingSchema:
+    """
+    Per-deployment preprocessing, loaded from JSON::
+
+        {
+          "defaults": {"missing": "nan", "absent": "zero"},
+          "features": {
+            "sex": {"categories": {"male": 1, "female": 0}, "default": 0},
+            "age": {"dtype": "int"}
+          }
+        }
+
+    ``defaults`` applies to every model feature without its own entry.
+    Declared features extend (and may override) the legacy ``sex`` encoding.
+    """
+
+    features: Dict[str, FeatureSpec] = field(default_factory=lambda: dict(LEGACY_FEATURES))
+    defaults: FeatureSpec = field(default_factory=FeatureSpec)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "PreprocessingSchema":
+        return cls(
+            features={
+                **LEGACY_FEATURES,
+                **{name: FeatureSpec(**spec) for name, spec in data.get("features", {}).items()},
+            },
+            defaults=FeatureSpec(**data.get("defaults", {})),
+        )
+
+    @classmethod
+    def from_file(cls, path: Union[str, Path]) -> "PreprocessingSchema":
+        with open(path, "r", encoding="utf-8") as handle:
+            return cls.from_dict(json.load(handle))
+
+    def to_dict(self) -> dict:
+        return {
+            "defaults": asdict(self.defaults),
+            "features": {name: asdict(spec) for name, spec in sorted(self.features.items())},
+        }
+
+    @property
+    def fingerprint(self) -> str:
+        payload = json.dumps(self.to_dict(), sort_keys=True).encode("utf-8")
+        return hashlib.sha256(payload).hexdigest()[:16]
+
+    def spec_for(self, name: str) -> FeatureSpec:
+        return self.features.get(name, self.defaults)
+
+    def transform(self, frame: pd.DataFrame, features: List[str]) -> np.ndarray:
+        """
+        Encode ``frame`` into a C-contiguous float32 matrix over ``features``.
+
+        Every step is a whole-column NumPy/pandas operation; the frame itself
+        is not modified.
+        """
+        matrix = np.empty((len(frame), len(features)), dtype=np.float32)
+        for position, name in enumerate(features):
+            spec = self.spec_for(name)
+            if name in frame.columns:
+                matrix[:, position] = spec.transform(frame[name])
+            else:
+                matrix[:, position] = _fill_value(spec.absent)
+        return matrix
+
+    def transform_array(
+        self, block: np.ndarray, columns: List[str], features: List[str]
+    ) -> np.ndarray:
+        """
+        Encode a numeric 2-D ``block`` whose columns are named ``columns``.
+
+        Used for memory-mapped matrices: plain features are gathered with one
+        fancy-indexing copy straight from the block, without pandas.
+        """
+        positions = {name: index for index, name in enumerate(columns)}
+        matrix = np.empty((len(block), len(features)), dtype=np.float32)
+        plain_targets: List[int] = []
+        plain_sources: List[int] = []
+        for position, name in enumerate(features):
+            spec = self.spec_for(name)
+            source = positions.get(name)
+            if source is None:
+                matrix[:, position] = _fill_value(spec.absent)
+            elif spec.is_plain:
+                plain_targets.append(position)
+                plain_sources.append(source)
+            else:
+                matrix[:, position] = spec.transform_values(block[:, source])
+        if plain_targets:
+            matrix[:, plain_targets] = block[:, plain_sources]
+        return matrix
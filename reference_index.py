@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""Per-model reference-population quantiles for turning risk scores into percentiles."""
+
+from __future__ import annotations
+
+import argparse
+import hashlib
+import logging
+import os
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Optional
+
+import numpy as np
+
+from lightgbm_engine import REFERENCE_FILENAME
+
+DEFAULT_QUANTILES = 1001
+
+
+def percentile_of(quantiles: np.ndarray, values: np.ndarray) -> np.ndarray:
+    """
+    Population percentile (0-100) of each value against sorted, evenly spaced quantiles.
+
+    One ``searchsorted`` locates every value's bin; the position inside the
+    bin is interpolated linearly. NaN stays NaN.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    steps = len(quantiles) - 1
+    upper = np.clip(np.searchsorted(quantiles, values, side="right"), 1, steps)
+    low, high = quantiles[upper - 1], quantiles[upper]
+    width = high - low
+    fraction = np.divide(values - low, width, out=np.ones_like(values), where=width > 0)
+    percentile = (upper - 1 + np.clip(fraction, 0.0, 1.0)) / steps * 100.0
+    return np.where(np.isnan(values), np.nan, percentile)
+
+
+@dataclass
+class ReferenceIndex:
+    """
+    Sorted quantile arrays of each model's scores over a reference cohort.
+
+    ``model_hashes`` records the model file each array was built from, so a
+    retrained model is never compared against a stale distribution.
+    """
+
+    quantiles: Dict[str, np.ndarray]
+    model_hashes: Dict[str, str]
+    cohort: str = ""
+    rows: int = 0
+
+    @property
+    def fingerprint(self) -> str:
+        digest = hashlib.sha256()
+        for name in sorted(self.quantiles):
+            digest.update(f"{name}:{self.model_hashes.get(name, '')}\n".encode("utf-8"))
+            digest.update(self.quantiles[name].tobytes())
+        return digest.hexdigest()[:16]
+
+    def percentiles(self, name: str, sha256: str, values: np.ndarray) -> Optional[np.ndarray]:
+        """Percentiles of ``values`` for model ``name``, or None without a matching reference."""
+        quantiles = self.quantiles.get(name)
+        if quantiles is None or self.model_hashes.get(name) != sha256:
+            return None
+        return percentile_of(quantiles, values)
+
+    def save(self, path: str) -> None:
+        arrays = {"models": np.asarray(sorted(self.quantiles))}
+        for name in sorted(self.quantiles):
+            arrays[f"{name}.quantiles"] = self.quantiles[name]
+            arrays[f"{name}.sha256"] = np.asarray(self.model_hashes[name])
+        arrays["cohort"] = np.asarray(self.cohort)
+        arrays["rows"] = np.asarray(self.rows)
+        np.savez(path, **arrays)
+
+    @classmethod
+    def load(cls, path: str) -> "ReferenceIndex":
+        with np.load(path, allow_pickle=False) as archive:
+            names = archive["models"].tolist()
+            return cls(
+                quantiles={name: archive[f"{name}.quantiles"] for name in names},
+                model_hashes={name: str(archive[f"{name}.sha256"]) for name in names},
+                cohort=str(archive["cohort"]),
+                rows=int(archive["rows"]),
+            )
+
+
+def build_reference(
+    engine, cohort_path: str, quantiles: int = DEFAULT_QUANTILES, chunksize: Optional[int] = None
+) -> ReferenceIndex:
+    """Score ``cohort_path`` with every model of ``engine``; keep ``quantiles`` quantiles each."""
+    models, layout = engine.select()
+    scores: Dict[str, list] = {model.name: [] for model in models}
+    rows = 0
+    for frame in engine.iter_input_frames(cohort_path, layout, chunksize):
+        predictions = engine.predict_matrix(engine.encode(frame, layout), models, layout)
+        for model in models:
+            if predictions[model.name] is not None:
+                scores[model.name].append(np.asarray(predictions[model.name], dtype=np.float64))
+        rows += len(frame)
+
+    probabilities = np.linspace(0.0, 1.0, quantiles)
+    index = ReferenceIndex({}, {}, cohort=os.path.basename(cohort_path), rows=rows)
+    for model in models:
+        values = np.concatenate(scores[model.name]) if scores[model.name] else np.empty(0)
+        values = values[~np.isnan(values)]
+        if not len(values):
+            logging.warning("No reference scores for %s; it will have no percentiles", model.name)
+            continue
+        index.quantiles[model.name] = np.quantile(values, probabilities)
+        index.model_hashes[model.name] = model.sha256
+    return index
+
+
+def run_cli() -> int:
+    from lightgbm_engine import EngineSettings, get_engine  # noqa: PLC0415
+
+    parser = argparse.ArgumentParser(
+        description="Build the reference-population quantiles used for risk percentiles."
+    )
+    parser.add_argument("cohort", type=Path, help="Reference cohort (CSV/Excel/Parquet/Feather).")
+    parser.add_argument("--model-dir", default=None, help="Model directory (default: as the CLI).")
+    parser.add_argument(
+        "--quantiles",
+        type=int,
+        default=DEFAULT_QUANTILES,
+        help=f"Quantiles kept per model (default: {DEFAULT_QUANTILES}).",
+    )
+    parser.add_argument("--chunksize", type=int, default=None, help="Rows per scoring chunk.")
+    parser.add_argument(
+        "--output",
+        default=None,
+        help=f"Output file (default: <model-dir>/{REFERENCE_FILENAME}).",
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+
+    engine = get_engine(EngineSettings.from_env(args.model_dir))
+    index = build_reference(engine, str(args.cohort), args.quantiles, args.chunksize)
+    output = args.output or os.path.join(engine.settings.model_dir, REFERENCE_FILENAME)
+    index.save(output)
+    print(
+        f"Saved {len(index.quantiles)} reference distributions over {index.rows} rows to {output}"
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(run_cli())
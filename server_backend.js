@@ -9,7 +9,7 @@ const bcrypt = require('bcryptjs');
 const mysql = require('mysql2/promise');
 const multer = require('multer');
 const app = express();
-const { execFile } = require('child_process');
+const { execFile, spawn } = require('child_process');
 app.use(bodyParser.json());
 app.use(express.json());
 app.use(express.urlencoded({ extended: false }));
@@ -369,33 +369,97 @@ async function processRAGFeedbackWithCOT(answer) {
 }
 
 
+// predict_cli.py runs as a small pool of resident `--serve` daemons so the
+// interpreter, imports and models stay warm; each request and reply is one
+// JSON line. A daemon scores one file at a time, so requests go to the
+// daemon with the fewest in flight. A request that outlives
+// PREDICT_TIMEOUT_MS is rejected and its daemon killed; the pool starts a
+// fresh one on the next request.
+const PREDICT_DAEMONS = Math.max(1, parseInt(process.env.PREDICT_DAEMONS || '2', 10));
+const PREDICT_TIMEOUT_MS = parseInt(process.env.PREDICT_TIMEOUT_MS || '300000', 10);
+const predictDaemons = new Array(PREDICT_DAEMONS).fill(null);
+let predictRequestSeq = 0;
+
+function spawnPredictDaemon(slot) {
+  const child = spawn(PYTHON, [SCRIPT, '--serve'], {
+    cwd: path.join(__dirname, 'longevity_app'),
+    stdio: ['pipe', 'pipe', 'pipe']
+  });
+  child.pending = new Map();
+  child.slot = slot;
+
+  let buffered = '';
+  child.stdout.setEncoding('utf8');
+  child.stdout.on('data', (chunk) => {
+    buffered += chunk;
+    let newline;
+    while ((newline = buffered.indexOf('\n')) >= 0) {
+      const line = buffered.slice(0, newline).trim();
+      buffered = buffered.slice(newline + 1);
+      if (!line) continue;
+
+      let reply;
+      try {
+        reply = JSON.parse(line);
+      } catch (e) {
+        console.error('[PY DAEMON] Unparseable output:', line);
+        continue;
+      }
+      const pending = child.pending.get(reply.id);
+      if (!pending) continue;
+      child.pending.delete(reply.id);
+      clearTimeout(pending.timer);
+      if (reply.ok) pending.resolve(reply);
+      else pending.reject(new Error(reply.error || 'Prediction failed'));
+    }
+  });
+  child.stderr.on('data', (chunk) => console.error('[PY STDERR]', chunk.toString()));
+
+  const fail = (err) => {
+    if (predictDaemons[slot] === child) predictDaemons[slot] = null;
+    for (const pending of child.pending.values()) {
+      clearTimeout(pending.timer);
+      pending.reject(err);
+    }
+    child.pending.clear();
+  };
+  child.on('error', fail);
+  child.stdin.on('error', fail);
+  child.on('exit', (code, signal) =>
+    fail(new Error(`predict daemon exited (code=${code}, signal=${signal})`)));
+
+  predictDaemons[slot] = child;
+  return child;
+}
+
+function getPredictDaemon() {
+  let best = -1;
+  for (let slot = 0; slot < predictDaemons.length; slot++) {
+    const daemon = predictDaemons[slot];
+    if (!daemon) return spawnPredictDaemon(slot);
+    if (best < 0 || daemon.pending.size < predictDaemons[best].pending.size) best = slot;
+  }
+  return predictDaemons[best];
+}
+
 function runPredictPython(filePathRel) {
-  // è‹¥å·²æ˜¯ç»å¯¹è·¯å¾„åˆ™ä¿æŒï¼Œä¸ç„¶æ‹¼æˆç»å¯?
   const filePath = path.isAbsolute(filePathRel)
                    ? filePathRel
                    : path.join(__dirname, filePathRel);
 
   return new Promise((resolve, reject) => {
-    execFile(
-      PYTHON,
-      [SCRIPT, filePath],
-      {
-        cwd: path.join(__dirname, 'longevity_app')    // å…³é”®ï¼šåˆ‡åˆ?app æ ?
-      },
-      (error, stdout, stderr) => {
-        if (stderr) console.error('[PY STDERR]', stderr);
-        if (error)  return reject(error);
-
-        try {
-          const lastLine = stdout.trim().split('\n').pop();
-          const data     = JSON.parse(lastLine);      // åªè§£æžæœ€åŽä¸€è¡?JSON
-          resolve(data);
-        } catch (e) {
-          console.error('è§£æž Python è¾“å‡ºå¤±è´¥:', stdout);
-          reject(e);
-        }
-      }
-    );
+    const daemon = getPredictDaemon();
+    const id = ++predictRequestSeq;
+    const timer = setTimeout(() => {
+      if (!daemon.pending.delete(id)) return;
+      reject(new Error(`Prediction timed out after ${PREDICT_TIMEOUT_MS} ms`));
+      // The daemon is stuck on (or queued behind) this file; replace it.
+      // Its other requests are rejected by the exit handler.
+      if (predictDaemons[daemon.slot] === daemon) predictDaemons[daemon.slot] = null;
+      daemon.kill('SIGKILL');
+    }, PREDICT_TIMEOUT_MS);
+    daemon.pending.set(id, { resolve, reject, timer });
+    daemon.stdin.write(JSON.stringify({ id, file_path: filePath }) + '\n');
   });
 }
 
@@ -0,0 +1,60 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+FEATURES = [f"P{i}" for i in range(6)]
+
+
+@pytest.fixture(scope="session")
+def model_dir(tmp_path_factory):
+    """Two small binary boosters over P0-P5 and sex, saved like the production models."""
+    import lightgbm as lgb
+
+    directory = tmp_path_factory.mktemp("models")
+    rng = np.random.default_rng(0)
+    frame = pd.DataFrame(rng.normal(size=(400, len(FEATURES))), columns=FEATURES)
+    frame["sex"] = rng.integers(0, 2, len(frame)).astype(float)
+    for offset, code in enumerate(["I10", "E11"]):
+        columns = FEATURES[offset : offset + 4] + ["sex"]
+        target = (frame[columns[0]] + rng.normal(size=len(frame)) > 0.5).astype(int)
+        booster = lgb.train(
+            {"objective": "binary", "verbose": -1, "num_leaves": 7},
+            lgb.Dataset(frame[columns], target),
+            num_boost_round=10,
+        )
+        booster.save_model(str(directory / f"model_{code}.model"))
+    return directory
+
+
+@pytest.fixture
+def cohort():
+    """A small input table in the upload layout (eid, sex labels, features)."""
+    rng = np.random.default_rng(1)
+    frame = pd.DataFrame(rng.normal(size=(50, len(FEATURES))), columns=FEATURES)
+    frame.insert(0, "eid", np.arange(1000, 1050))
+    frame["sex"] = np.where(rng.integers(0, 2, len(frame)) == 1, "male", "female")
+    return frame
+
+
+@pytest.fixture
+def client(model_dir, tmp_path, monkeypatch):
+    import app_lightgbm_service as service
+
+    for key, value in {
+        "MODEL_DIR": str(model_dir),
+        "UPLOAD_FOLDER": str(tmp_path / "uploads"),
+        "PREDICTION_CACHE_MAX_BYTES": 0,
+        "PREDICTION_STORE": str(tmp_path / "predictions.sqlite3"),
+        "JOB_STATE_DIR": str(tmp_path / "jobs"),
+        "ARCHIVE_CACHE_DIR": "",
+        "OUTPUT_FORMAT": "csv",
+        "OUTPUT_COMPRESSION": "",
+        "OUTPUT_PRECISION": 0,
+    }.items():
+        monkeypatch.setitem(service.app.config, key, value)
+    return service.app.test_client()
@@ -0,0 +1,105 @@
+import os
+
+import pandas as pd
+import pytest
+
+from lightgbm_engine import EngineSettings, get_engine, read_manifest
+
+
+@pytest.fixture
+def engine(model_dir):
+    return get_engine(EngineSettings(model_dir=str(model_dir), cpu_budget=2, cache_max_bytes=0))
+
+
+def test_inputs_sharing_a_stem_keep_separate_predictions(engine, cohort, tmp_path):
+    csv_input = tmp_path / "x.csv"
+    parquet_input = tmp_path / "x.parquet"
+    cohort.to_csv(csv_input, index=False)
+    cohort.iloc[:20].to_parquet(parquet_input)
+    out = tmp_path / "out"
+    out.mkdir()
+
+    from_csv, _ = engine.predict_file(str(csv_input), str(out))
+    from_parquet, _ = engine.predict_file(str(parquet_input), str(out))
+
+    assert os.path.basename(from_csv) == "predictions_x.csv"
+    assert os.path.basename(from_parquet) == "predictions_x.parquet.csv"
+    assert len(pd.read_csv(from_csv)) == 50
+    assert len(pd.read_csv(from_parquet)) == 20
+    assert read_manifest(from_csv)["input"] == str(csv_input)
+    assert read_manifest(from_parquet)["input"] == str(parquet_input)
+
+
+def test_cache_hit_is_served_before_any_booster_is_parsed(model_dir, cohort, tmp_path):
+    from lightgbm_engine import ScoringEngine
+
+    settings = EngineSettings(
+        model_dir=str(model_dir),
+        cpu_budget=2,
+        cache_dir=str(tmp_path / "cache"),
+        cache_max_bytes=1 << 20,
+    )
+    source = tmp_path / "x.csv"
+    cohort.to_csv(source, index=False)
+    first_info, second_info = {}, {}
+
+    warm = ScoringEngine(settings)
+    first, _ = warm.predict_file(str(source), str(tmp_path), run_info=first_info)
+    cold = ScoringEngine(settings)
+    second, _ = cold.predict_file(str(source), str(tmp_path), run_info=second_info)
+
+    assert (first_info["cache"], second_info["cache"]) == ("miss", "hit")
+    assert cold.registry.models() == []
+    assert read_manifest(second)["models"] == read_manifest(first)["models"]
+
+
+def test_contributions_stream_into_one_archive_per_input(engine, cohort, tmp_path):
+    import numpy as np
+
+    from lightgbm_engine import top_proteins
+
+    source = tmp_path / "x.csv"
+    cohort.to_csv(source, index=False)
+    chunked, whole = tmp_path / "chunked", tmp_path / "whole"
+    chunked.mkdir()
+    whole.mkdir()
+    chunked_info, whole_info = {}, {}
+
+    engine.predict_file(
+        str(source), str(chunked), chunksize=7, contributions=3, run_info=chunked_info
+    )
+    engine.predict_file(str(source), str(whole), contributions=3, run_info=whole_info)
+
+    assert os.path.basename(chunked_info["contributions_file"]) == "contributions_x.csv.npz"
+    assert sorted(os.listdir(chunked)) == sorted(os.listdir(whole))
+    with np.load(chunked_info["contributions_file"], allow_pickle=False) as streamed, np.load(
+        whole_info["contributions_file"], allow_pickle=False
+    ) as single:
+        assert sorted(streamed.files) == sorted(single.files)
+        for key in single.files:
+            np.testing.assert_array_equal(streamed[key], single[key])
+        assert streamed["ids"].tolist() == cohort["eid"].tolist()
+        assert streamed["model_I10.index"].shape == (50, 3)
+    assert top_proteins(chunked_info["contributions_file"], 0, 4)
+
+
+def test_uncached_runs_do_not_hash_the_input(engine, cohort, tmp_path, monkeypatch):
+    import lightgbm_engine
+
+    def no_digest(filepath):
+        raise AssertionError(f"{filepath} was hashed")
+
+    source = tmp_path / "x.csv"
+    cohort.to_csv(source, index=False)
+    monkeypatch.setattr(lightgbm_engine, "_input_digest", no_digest)
+
+    result, _ = engine.predict_file(str(source), str(tmp_path))
+    manifest = read_manifest(result)
+    assert manifest["input_digest"] is None
+    assert manifest["input_stat"][0][0] == source.stat().st_size
+
+    engine.rescore_file(result)
+    with open(source, "a", encoding="utf-8") as handle:
+        handle.write(cohort.iloc[:1].to_csv(index=False, header=False))
+    with pytest.raises(ValueError, match="changed since"):
+        engine.rescore_file(result)
@@ -0,0 +1,22 @@
+import sys
+
+import pytest
+
+import predict_cli
+
+
+@pytest.mark.parametrize("flag", ["--models", "--exclude-models"])
+def test_unknown_model_term_is_a_usage_error(
+    model_dir, cohort, tmp_path, monkeypatch, capsys, flag
+):
+    source = tmp_path / "x.csv"
+    cohort.to_csv(source, index=False)
+    argv = ["predict_cli.py", str(source), "--model-dir", str(model_dir), flag, "nope"]
+    monkeypatch.setattr(sys, "argv", argv)
+
+    with pytest.raises(SystemExit) as exit_info:
+        predict_cli.main()
+
+    assert exit_info.value.code == 2
+    assert "Unknown model or tag: nope" in capsys.readouterr().err
+    assert not (tmp_path / "predictions_x.csv").exists()
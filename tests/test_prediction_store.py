@@ -0,0 +1,19 @@
+import pandas as pd
+
+from prediction_store import PredictionStore
+
+
+def test_ingest_stores_eids_as_written_and_skips_missing_ones(tmp_path):
+    result = tmp_path / "predictions_x.csv"
+    # A blank eid makes pandas read the whole column as floats.
+    pd.DataFrame(
+        {"eid": [1000, None, 1002], "model_I10": [0.1, 0.2, 0.3], "model_I10_percentile": 50.0}
+    ).to_csv(result, index=False)
+    store = PredictionStore(str(tmp_path / "store.sqlite3"))
+
+    store.ingest(str(result), "alice", "x.csv", "v1", ["model_I10"])
+
+    assert [row["score"] for row in store.latest("1000")] == [0.1]
+    assert [row["score"] for row in store.latest("1002")] == [0.3]
+    assert store.latest("1000.0") == []
+    assert store.latest("nan") == []
@@ -0,0 +1,22 @@
+import numpy as np
+import pandas as pd
+
+from preprocessing import PreprocessingSchema
+
+
+def test_legacy_sex_encoding_matches_the_original_exact_match():
+    values = ["male", "Male", " MALE ", "female", "1", "1.0", 1, 1.0, 0, None, np.nan, "x"]
+    column = pd.Series(values, dtype=object)
+
+    encoded = PreprocessingSchema().transform(pd.DataFrame({"sex": column}), ["sex"])
+
+    assert encoded[:, 0].tolist() == [1, 0, 0, 0, 1, 0, 1, 1, 0, 0, 0, 0]
+
+
+def test_declared_categories_match_case_insensitively():
+    schema = PreprocessingSchema.from_dict(
+        {"features": {"sex": {"categories": {"male": 1, "female": 0}, "default": 0}}}
+    )
+    frame = pd.DataFrame({"sex": ["Male", " FEMALE ", "male", "other"]})
+
+    assert schema.transform(frame, ["sex"])[:, 0].tolist() == [1, 0, 1, 0]
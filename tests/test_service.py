@@ -0,0 +1,52 @@
+import json
+import math
+
+
+def _reject_constant(name):
+    raise ValueError(f"{name} is not valid JSON")
+
+
+def test_score_echoes_each_records_eid(client):
+    records = [{"eid": 1000, "P0": 0.5, "sex": "male"}, {"P0": -1.0}, {"eid": "A-7", "P1": 2.0}]
+    response = client.post("/api/score", json={"records": records})
+
+    assert response.status_code == 200
+    body = json.loads(response.get_data(as_text=True), parse_constant=_reject_constant)
+    rows = body["predictions"]
+    assert [row["row_id"] for row in rows] == [1, 2, 3]
+    assert [row["eid"] for row in rows] == [1000, None, "A-7"]
+    for row in rows:
+        assert all(0.0 <= row[name] <= 1.0 for name in body["models"])
+
+
+def test_score_without_eids_reports_row_ids_only(client):
+    response = client.post("/api/score", json=[{"P0": 0.1}, {"P0": 0.2}])
+
+    rows = response.get_json()["predictions"]
+    assert [row["row_id"] for row in rows] == [1, 2]
+    assert all("eid" not in row and not math.isnan(row["model_I10"]) for row in rows)
+
+
+def test_job_left_running_by_an_exited_worker_reads_as_failed(tmp_path):
+    import subprocess
+    import sys
+
+    from app_lightgbm_service import JobQueue, PredictionJob
+
+    exited = subprocess.Popen([sys.executable, "-c", "pass"])
+    exited.wait()
+    job = PredictionJob(
+        job_id="a" * 32, filename="x.csv", filepath="x.csv", user_dir=str(tmp_path)
+    )
+    job.status = "running"
+    owner = JobQueue(1, 1, 3600, state_dir=str(tmp_path / "jobs"))
+    owner.save(job, force=True)
+    state_path = tmp_path / "jobs" / f"{job.job_id}.json"
+    state = json.loads(state_path.read_text())
+    state_path.write_text(json.dumps(dict(state, pid=exited.pid)))
+
+    other_worker = JobQueue(1, 1, 3600, state_dir=str(tmp_path / "jobs"))
+    found = other_worker.get(job.job_id)
+
+    assert found.status == "failed"
+    assert "interrupted" in found.error